@@ -0,0 +1,85 @@
+from typing import Optional, Dict, Any
+
+from sqlalchemy import select, func, case
+
+from cache import RepositoryCache, MISSING
+from db_construction import Building, BuildingType, Stop, StopsToRoute, Route
+
+# Таблицы, от которых зависят отчёты: их версии входят в ключ кэша
+REPORT_TABLES = ('building', 'stop', 'stops_to_route', 'route')
+
+
+class CatchmentReports:
+    """Отчёты о зоне обслуживания остановок, посчитанные агрегатами SQL.
+
+    Результаты кэшируются до любой записи в building, stop, stops_to_route или route.
+    """
+
+    def __init__(self, session, cache: Optional[RepositoryCache] = None):
+        self.session = session
+        self.cache = cache
+
+    def stops(self) -> list[Dict[str, Any]]:
+        """Число зданий каждого типа, которые обслуживает каждая остановка."""
+        return self._cached('stops', self._stops)
+
+    def routes(self, top: int = 3) -> list[Dict[str, Any]]:
+        """Здания в зоне каждого маршрута и top остановок маршрута по числу зданий."""
+        return self._cached(f'routes:{top}', lambda: self._routes(top))
+
+    def _stops(self) -> list[Dict[str, Any]]:
+        query = (select(Stop.stop_id, Stop.stop_name, *_building_counts())
+                 .join(Building, Building.stop_id == Stop.stop_id)
+                 .group_by(Stop.stop_id, Stop.stop_name)
+                 .order_by(func.sum(_is_residential()).desc(), Stop.stop_id))
+        return [dict(row) for row in self.session.execute(query).mappings()]
+
+    def _routes(self, top: int) -> list[Dict[str, Any]]:
+        per_route = (select(Route.route_id, Route.route_number, *_building_counts())
+                     .join(StopsToRoute, StopsToRoute.route_id == Route.route_id)
+                     .join(Building, Building.stop_id == StopsToRoute.stop_id)
+                     .group_by(Route.route_id, Route.route_number)
+                     .order_by(Route.route_number))
+        reports = {row['route_id']: dict(row, top_stops=[]) for row in self.session.execute(per_route).mappings()}
+
+        per_stop = (select(StopsToRoute.route_id, Stop.stop_id, Stop.stop_name,
+                           func.count(Building.building_id).label('buildings'))
+                    # route_id может быть NULL: такие строки не относятся ни к одному маршруту
+                    .join(Route, Route.route_id == StopsToRoute.route_id)
+                    .join(Stop, Stop.stop_id == StopsToRoute.stop_id)
+                    .join(Building, Building.stop_id == Stop.stop_id)
+                    .group_by(StopsToRoute.route_id, Stop.stop_id, Stop.stop_name)
+                    .subquery())
+        rank = func.row_number().over(partition_by=per_stop.c.route_id,
+                                      order_by=(per_stop.c.buildings.desc(), per_stop.c.stop_id)).label('rank')
+        ranked = select(per_stop, rank).subquery()
+        top_stops = (select(ranked.c.route_id, ranked.c.stop_id, ranked.c.stop_name, ranked.c.buildings)
+                     .where(ranked.c.rank <= top)
+                     .order_by(ranked.c.route_id, ranked.c.rank))
+        for row in self.session.execute(top_stops).mappings():
+            report = reports.get(row['route_id'])
+            if report is not None:
+                report['top_stops'].append(
+                    {'stop_id': row['stop_id'], 'stop_name': row['stop_name'], 'buildings': row['buildings']})
+        return list(reports.values())
+
+    def _cached(self, name: str, compute):
+        if self.cache is None:
+            return compute()
+        versions = '.'.join(str(self.cache.version(table)) for table in REPORT_TABLES)
+        key = f"catchment:{name}:{versions}"
+        result = self.cache.get(key)
+        if result is MISSING:
+            result = compute()
+            self.cache.set(key, result)
+        return result
+
+
+def _is_residential():
+    return case((Building.building_type == BuildingType.residential, 1), else_=0)
+
+
+def _building_counts():
+    return (func.count(Building.building_id).label('buildings'),
+            *(func.sum(case((Building.building_type == building_type, 1), else_=0)).label(building_type.value)
+              for building_type in BuildingType))
@@ -1,15 +1,38 @@
-from flask import Flask, render_template, request
+import csv
+import enum
+import io
+import json
+import os
+
+import click
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from flask_csp.csp import csp_default, csp_header
-from sqlalchemy import create_engine, URL
-from sqlalchemy.orm import sessionmaker
-
-from db_construction import DATABASE, DeclarativeBase, Street, Stop, Building, Route, PublicTransport, StopsToRoute
-from db_interactions import generate_db
-from exceptions import exception_message, web_exception
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn, AddConstraint
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+import http_cache
+import metrics
+from analytics import CatchmentReports
+from cache import cache_from_env, MISSING
+from change_feed import change_feed_for, sse_lines, stream_lifetime
+from db_backend import create_db_engine, check_connection
+from db_construction import DeclarativeBase
+from db_interactions import seed_db
+from db_routing import ReplicaRouter, RoutingSession, pin_primary, replica_urls
+from exceptions import exception_message, web_exception, StaleRowError
+from route_planner import RoutePlanner
+from registry import ModelRegistry
+from route_timeline import RouteTimelineView
+from search import SearchService
+from snapshot import Snapshot, warm_start, write_snapshot
 from repositories import (StreetRepository, StopRepository, RouteRepository,
-                          StopsToRouteRepository, BuildingRepository, PublicTransportRepository, IRepository)
+                          StopsToRouteRepository, BuildingRepository, PublicTransportRepository, IRepository,
+                          dependent_tables)
 
 app = Flask(__name__)
+metrics.instrument_app(app)
+http_cache.enable_compression(app)
 default_policies = csp_default()
 default_policies.update({
     'default-src': "'self'",
@@ -23,51 +46,406 @@ default_policies.update({
 
 class DBConnector:
     def __init__(self):
+        self.engine = None
+        self.router = None
         self.session = None
 
     def db_connection(self):
         try:
-            engine = create_engine(URL(**DATABASE), echo=True)
-
-            session = sessionmaker(bind=engine)
-
-            self.session = session()
-            DeclarativeBase.metadata.create_all(engine)
+            # Адрес и настройки бд - из DATABASE_URL, DB_CONFIG или DATABASE (db_backend.py)
+            self.engine = create_db_engine(echo=os.environ.get('SQL_ECHO') == '1')
+            check_connection(self.engine)
+            metrics.instrument_engine(self.engine)
+            # Чтение уходит на реплики из DB_REPLICA_URLS, запись - на self.engine
+            self.router = ReplicaRouter.from_urls(self.engine, replica_urls)
+            for replica in self.router.replicas:
+                metrics.instrument_engine(replica)
+
+            # Своя сессия на каждый поток/запрос; репозитории работают через этот прокси
+            self.session = scoped_session(sessionmaker(bind=self.engine, class_=RoutingSession, router=self.router))
         except Exception as e:
             exception_message("Ошибка подключения к бд", e)
+            # Без бд приложение всё равно не работает: лучше упасть сразу с понятной ошибкой
+            raise
 
-    def db_generation(self):
+    def db_schema_creation(self):
         try:
-            generate_db(self.session)
+            DeclarativeBase.metadata.create_all(self.engine)
+            # create_all не добавляет новые индексы в уже существующие таблицы
+            for table in DeclarativeBase.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(self.engine, checkfirst=True)
+            self.add_missing_columns()
+            self.add_cascade_deletes()
+        except Exception as e:
+            exception_message("Ошибка создания схемы бд", e)
+
+    def add_missing_columns(self):
+        # create_all не добавляет и новые столбцы; добавляются только столбцы со значением по умолчанию
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table in DeclarativeBase.metadata.sorted_tables:
+                existing = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing and column.server_default is not None:
+                        definition = CreateColumn(column).compile(dialect=self.engine.dialect)
+                        connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+
+    def add_cascade_deletes(self):
+        # create_all не меняет и внешние ключи: в PostgreSQL они пересоздаются с ON DELETE CASCADE
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table in DeclarativeBase.metadata.sorted_tables:
+                existing = inspector.get_foreign_keys(table.name)
+                for constraint in table.foreign_key_constraints:
+                    columns = [column.name for column in constraint.columns]
+                    outdated = [key for key in existing if key['constrained_columns'] == columns
+                                and (key.get('options') or {}).get('ondelete', '').upper() != constraint.ondelete]
+                    if constraint.ondelete is None or not outdated:
+                        continue
+                    if self.engine.dialect.name != 'postgresql':
+                        print(f"Внешний ключ {table.name}({', '.join(columns)}) без ON DELETE CASCADE: "
+                              f"удаление с зависимыми строками не пройдёт, пересоздайте бд")
+                        continue
+                    for key in outdated:
+                        connection.execute(text(f'ALTER TABLE {table.name} DROP CONSTRAINT "{key["name"]}"'))
+                    connection.execute(AddConstraint(constraint))
+
+    def db_generation(self, mode: str = 'auto') -> str:
+        try:
+            # Проверка и генерация должны видеть основную бд, а не отстающую реплику
+            pin_primary(self.session)
+            return seed_db(self.session, mode)
         except Exception as e:
             exception_message("Ошибка генерации базы данных", e)
+            return 'failed'
+        finally:
+            self.session.remove()
 
     def db_disconnect(self):
-        self.session.close()
+        change_feed.close()
+        self.session.remove()
+        self.engine.dispose()
+        for replica in self.router.replicas:
+            replica.dispose()
 
-    def repository_creation(self):
-        return (StreetRepository(self.session), StopRepository(self.session),
-                BuildingRepository(self.session), RouteRepository(self.session),
-                PublicTransportRepository(self.session), StopsToRouteRepository(self.session))
+    def repository_creation(self, cache=None):
+        repositories = (StreetRepository(self.session), StopRepository(self.session),
+                        BuildingRepository(self.session), RouteRepository(self.session),
+                        PublicTransportRepository(self.session), StopsToRouteRepository(self.session))
+        for repository in repositories:
+            repository.cache = cache
+        return repositories
 
 
 db_connector = DBConnector()
 db_connector.db_connection()
-db_connector.db_generation()
+repository_cache = cache_from_env()
 (street_repository, stop_repository, building_repository,
- route_repository, public_transport_repository, stops_to_route_repository) = db_connector.repository_creation()
+ route_repository, public_transport_repository,
+ stops_to_route_repository) = db_connector.repository_creation(repository_cache)
+
+# Подписи таблиц на страницах; новая таблица подключается одной строкой
+model_registry = ModelRegistry()
+model_registry.register("Улица", street_repository)
+model_registry.register("Остановка", stop_repository)
+model_registry.register("Здание", building_repository)
+model_registry.register("Маршрут", route_repository)
+model_registry.register("Общественный транспорт", public_transport_repository)
+model_registry.register("Остановки на маршруте", stops_to_route_repository)
+
+# События изменений строк для /changes; удаление таблицы каскадно задевает зависимые
+change_feed = change_feed_for(db_connector.engine)
+for repository in model_registry.repositories():
+    table = repository.model.__table__
+    repository.change_listeners.append(
+        change_feed.listener(table.name, tuple(dependent.name for dependent in dependent_tables(table)[1:])))
+
+route_planner = RoutePlanner(db_connector.session)
+stops_to_route_repository.change_listeners.append(route_planner.on_stops_to_route_change)
+route_repository.change_listeners.append(route_planner.on_route_change)
+stop_repository.change_listeners.append(route_planner.on_stop_change)
+street_repository.change_listeners.append(route_planner.on_street_change)
+
+route_timeline = RouteTimelineView(db_connector.session)
+stops_to_route_repository.change_listeners.append(route_timeline.on_route_change)
+public_transport_repository.change_listeners.append(route_timeline.on_route_change)
+route_repository.change_listeners.append(route_timeline.on_route_change)
+stop_repository.change_listeners.append(route_timeline.on_stop_change)
+street_repository.change_listeners.append(route_timeline.on_street_change)
+
+catchment_reports = CatchmentReports(db_connector.session, repository_cache)
+
+search_service = SearchService(db_connector.session)
+stop_repository.change_listeners.append(search_service.on_stop_change)
+street_repository.change_listeners.append(search_service.on_street_change)
+route_repository.change_listeners.append(search_service.on_route_change)
+
+
+def init_db(mode: str = 'auto') -> str:
+    db_connector.db_schema_creation()
+    result = db_connector.db_generation(mode)
+    if result != 'skipped':
+        # Генерация меняет таблицы в обход репозиториев
+        for table in DeclarativeBase.metadata.sorted_tables:
+            repository_cache.invalidate(table.name)
+        route_planner.invalidate_all()
+        search_service.invalidate_all()
+        route_timeline.refresh_all()
+        db_connector.session.remove()
+    return result
+
+
+@app.cli.command('init-db')
+@click.option('--mode', type=click.Choice(['auto', 'reconcile', 'force']), default='auto',
+              help='auto - пропустить уже заполненную базу, reconcile - добавить недостающие строки, '
+                   'force - сгенерировать заново')
+def init_db_command(mode):
+    """Создаёт схему и заполняет базу начальными данными."""
+    click.echo(init_db(mode))
+
+
+def warm_from_snapshot(directory: str) -> dict:
+    try:
+        with Snapshot(directory) as network:
+            return warm_start(network, db_connector.session, model_registry.repositories(), repository_cache,
+                              route_planner)
+    except Exception as e:
+        exception_message("Ошибка загрузки снимка", e)
+        return {}
+    finally:
+        db_connector.session.remove()
+
+
+@app.cli.command('snapshot')
+@click.option('--output', default='snapshot', show_default=True, help='каталог снимка')
+def snapshot_command(output):
+    """Сохраняет таблицы сети в столбцовый снимок (.npy) для анализа и быстрого старта."""
+    try:
+        manifest = write_snapshot(db_connector.session, output)
+        click.echo(json.dumps({name: table['rows'] for name, table in manifest['tables'].items()}))
+    finally:
+        db_connector.session.remove()
+
+
+@app.teardown_request
+def refresh_route_timeline(exception=None):
+    route_timeline.refresh_pending()
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    if db_connector.session is not None:
+        db_connector.session.remove()
 
 
 @app.route('/show_tables', methods=['GET', 'POST'])
 @csp_header()
 def show_tables():
     selected_table = request.form.get('table_selection', 'Улица')
-    table_data = choose_repository(selected_table).all()
     column_names = find_columns_name(selected_table)
-    print("Street", selected_table)
+    r = choose_repository(selected_table)
+
+    return render_template('show_tables.html', selected_table=selected_table,
+                           column_count=len(column_names), column_names=column_names,
+                           primary_key=r.info.primary_key.name if r is not None else None)
+
+
+@app.route('/show_tables/data', methods=['GET'])
+def show_tables_data():
+    # Серверный протокол DataTables: в браузер отдаётся только видимое окно таблицы
+    selected_table = request.args.get('table', 'Улица')
+    r = choose_repository(selected_table)
+    if r is None:
+        return jsonify({'error': 'Неизвестная таблица'}), 400
+
+    start = request.args.get('start', 0, type=int)
+    length = request.args.get('length', 10, type=int)
+    order_column = request.args.get('order[0][column]', 0, type=int)
+    order_dir = request.args.get('order[0][dir]', 'asc')
+    search = request.args.get('search[value]', '')
+    draw = request.args.get('draw', 0, type=int)
+
+    table_name = r.model.__tablename__
+    etag, last_modified = http_cache.validators(repository_cache, [table_name])
+    response = http_cache.not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    # Готовый JSON окна без draw, ключ содержит версию таблицы
+    key = repository_cache.key(table_name, 'fragment', (max(start, 0), length, order_column, order_dir, search))
+    fragment = repository_cache.get(key)
+    if fragment is MISSING:
+        total, filtered, rows = r.page(max(start, 0), length, order_column, order_dir, search)
+        fragment = json.dumps({
+            'recordsTotal': total,
+            'recordsFiltered': filtered,
+            'data': [[plain_cell(cell) for cell in row] for row in rows],
+        }, ensure_ascii=False)
+        if len(rows) <= repository_cache.max_cached_rows:
+            repository_cache.set(key, fragment)
+    body = f'{{"draw": {draw}, {fragment[1:]}'
+    return http_cache.conditional(Response(body, mimetype='application/json'), etag, last_modified)
+
+
+@app.route('/changes', methods=['GET'])
+def changes():
+    # Server-Sent Events: /changes?table=Улица, без table - изменения всех таблиц
+    tables = None
+    if request.args.get('table'):
+        r = choose_repository(request.args['table'])
+        if r is None:
+            return jsonify({'error': 'Неизвестная таблица'}), 400
+        tables = {r.model.__tablename__}
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    # Поток ограничен по времени, чтобы открытые вкладки не держали потоки воркера бесконечно
+    events = change_feed.stream(tables, last_id, lifetime=stream_lifetime)
+    return Response(sse_lines(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/export/<export_format>', methods=['GET'])
+def export_table(export_format):
+    selected_table = request.args.get('table', 'Улица')
+    r = choose_repository(selected_table)
+    if r is None or export_format not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Неизвестная таблица или формат'}), 400
+
+    etag, last_modified = http_cache.validators(repository_cache, [r.model.__tablename__])
+    response = http_cache.not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    column_names = find_columns_name(selected_table)
+    rows = r.iter_rows()
+    if export_format == 'csv':
+        body, mimetype = _csv_lines(column_names, rows), 'text/csv'
+    else:
+        body, mimetype = _ndjson_lines(column_names, rows), 'application/x-ndjson'
+
+    filename = f"{r.model.__tablename__}.{export_format}"
+    response = Response(stream_with_context(body), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
+    return http_cache.conditional(response, etag, last_modified)
+
+
+@app.route('/route_plan', methods=['GET'])
+def route_plan():
+    from_stop = request.args.get('from', type=int)
+    to_stop = request.args.get('to', type=int)
+    if from_stop is None or to_stop is None:
+        return jsonify({'error': 'Нужно указать остановки from и to'}), 400
+
+    legs = route_planner.plan(from_stop, to_stop)
+    if legs is None:
+        return jsonify({'error': 'Маршрут между остановками не найден'}), 404
+    return jsonify({'transfers': max(len(legs) - 1, 0),
+                    'stops': sum(len(leg['stops']) - 1 for leg in legs),
+                    'legs': legs})
+
+
+@app.route('/search', methods=['GET'])
+def search():
+    # Автодополнение: /search?q=лесн&limit=10 -> остановки, улицы и маршруты
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    try:
+        results = search_service.search(query, limit)
+    except Exception as e:
+        web_exception(e)
+        return jsonify({'error': 'Ошибка поиска'}), 500
+    return jsonify({'query': query, 'results': results})
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(repository_cache.stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def _cache_metrics():
+    stats = repository_cache.stats()
+    return ['# TYPE roads_cache_hits_total counter', f"roads_cache_hits_total {stats['hits']}",
+            '# TYPE roads_cache_misses_total counter', f"roads_cache_misses_total {stats['misses']}"]
+
+
+def _replica_metrics():
+    if db_connector.router is None:
+        return []
+    return ['# TYPE roads_db_replica_healthy gauge'] + [
+        f'roads_db_replica_healthy{{url="{replica["url"]}"}} {int(replica["healthy"])}'
+        for replica in db_connector.router.status()]
+
+
+metrics.collectors.append(_cache_metrics)
+metrics.collectors.append(_replica_metrics)
+
+
+@app.route('/route_stops/<int:route_id>', methods=['GET', 'PUT'])
+def route_stops(route_id):
+    # PUT {"stops": [5, 2, 9]} - новый порядок остановок маршрута целиком, одной транзакцией
+    if request.method == 'GET':
+        return jsonify({'route_id': route_id, 'stops': stops_to_route_repository.route_stops(route_id)})
+
+    stops = (request.get_json(silent=True) or {}).get('stops')
+    if not isinstance(stops, list):
+        return jsonify({'error': 'Нужно указать список id остановок stops'}), 400
+    try:
+        stop_ids = [int(stop_id) for stop_id in stops]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Некорректное значение id остановки'}), 400
+    try:
+        result = stops_to_route_repository.resequence(route_id, stop_ids)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if result is None:
+        return jsonify({'error': 'Ошибка изменения маршрута'}), 500
+    return jsonify(result)
+
+
+@app.route('/route_timeline/<int:route_number>', methods=['GET'])
+def route_timeline_endpoint(route_number):
+    timeline = route_timeline.timeline(route_number)
+    if timeline is None:
+        return jsonify({'error': 'Такого маршрута нет'}), 404
+    return jsonify(timeline)
+
+
+@app.route('/reports/catchment', methods=['GET'])
+def catchment_report():
+    kind = request.args.get('kind', 'stops')
+    if kind == 'stops':
+        return jsonify(catchment_reports.stops())
+    if kind == 'routes':
+        return jsonify(catchment_reports.routes(request.args.get('top', 3, type=int)))
+    return jsonify({'error': 'Неизвестный отчёт'}), 400
 
-    return render_template('show_tables.html', table_data=table_data, selected_table=selected_table,
-                           column_count=len(column_names), column_names=column_names)
+
+def _csv_lines(column_names, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(column_names)
+    for row in rows:
+        writer.writerow([plain_cell(cell) for cell in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _ndjson_lines(column_names, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(column_names, map(plain_cell, row))), ensure_ascii=False) + '\n'
+
+
+def plain_cell(cell):
+    return str(cell) if isinstance(cell, enum.Enum) else cell
 
 
 @app.route('/change_info', methods=['GET', 'POST'])
@@ -84,6 +462,38 @@ def change_info():
                            input_fields=[])
 
 
+@app.route('/change_info/batch', methods=['POST'])
+def change_info_batch():
+    # {"table": "Остановка", "operations": [{"action": "add"|"update", "data": {...}} | {"action": "delete", "id": 1}]}
+    payload = request.get_json(silent=True) or {}
+    r = choose_repository(payload.get('table'))
+    operations = payload.get('operations')
+    if r is None or not isinstance(operations, list):
+        return jsonify({'error': 'Нужно указать таблицу и список операций'}), 400
+
+    results = r.apply_batch(operations)
+    return jsonify({'applied': sum(result['ok'] for result in results), 'results': results})
+
+
+@app.route('/change_info/delete', methods=['POST'])
+def change_info_delete():
+    # {"table": "Здание", "ids": [1, 2]} или {"table": "Здание", "filter": {"street_id": 5}}
+    payload = request.get_json(silent=True) or {}
+    r = choose_repository(payload.get('table'))
+    ids, filters = payload.get('ids'), payload.get('filter')
+    if r is None or isinstance(ids, list) == isinstance(filters, dict):
+        return jsonify({'error': 'Нужно указать таблицу и либо список ids, либо filter'}), 400
+
+    try:
+        deleted = r.delete_by_ids([int(_id) for _id in ids]) if isinstance(ids, list) else r.delete_by_filter(filters)
+    except (TypeError, ValueError, KeyError) as e:
+        return jsonify({'error': str(e)}), 400
+    if deleted is None:
+        return jsonify({'error': 'Ошибка удаления'}), 500
+    # Число удалённых строк по таблицам, включая каскадно удалённые
+    return jsonify({'deleted': deleted})
+
+
 def post_for_change_info():
     action = request.form.get('action')
     selected_table = request.form.get("selected_table")
@@ -102,7 +512,13 @@ def post_for_change_info():
         except ValueError:
             web_exception(Exception("Некорректное значение id"))
     elif action in ['update', 'add', 'delete']:
-        data = handle_update_add_delete(action)
+        try:
+            data = handle_update_add_delete(action)
+        except StaleRowError as e:
+            # Показываем текущие значения строки, чтобы изменение можно было повторить
+            web_exception(e)
+            return render_template('change_info.html', selected_table=selected_table, object=column_names,
+                                   input_fields=list(e.current.values()), message=str(e))
         return render_template('change_info.html', selected_table=selected_table,
                                object=column_names, input_fields=data)
 
@@ -116,9 +532,12 @@ def handle_update_add_delete(action):
 
     r = choose_repository(selected_table)
     if action == 'update':
-        r.update_list(data)
+        row = r.update_list(data)
+        if row is not None:
+            # Новая версия строки остаётся в форме для следующего изменения
+            return list(row.values())
     elif action == 'add':
-        data.pop(request.form.get('id_name'))
+        # Пустой id - новая строка, заданный id - добавление или перезапись этой строки
         r.add_list(data)
     elif action == 'delete':
         id_name = data.get(request.form.get('id_name'))
@@ -134,37 +553,16 @@ def entity_in_strings(selected_table: str, id: int) -> list[str]:
 
 
 def choose_repository(selected_table: str) -> IRepository:
-    if selected_table == "Улица":
-        return street_repository
-    elif selected_table == "Остановка":
-        return stop_repository
-    elif selected_table == "Здание":
-        return building_repository
-    elif selected_table == "Маршрут":
-        return route_repository
-    elif selected_table == "Общественный транспорт":
-        return public_transport_repository
-    elif selected_table == "Остановки на маршруте":
-        return stops_to_route_repository
+    return model_registry.repository(selected_table)
 
 
 def find_columns_name(selected_table: str) -> list[str]:
-    column_names = []
+    return model_registry.column_names(selected_table)
 
-    if selected_table == "Улица":
-        column_names = list(Street.__table__.columns)
-    elif selected_table == "Остановка":
-        column_names = list(Stop.__table__.columns)
-    elif selected_table == "Здание":
-        column_names = list(Building.__table__.columns)
-    elif selected_table == "Маршрут":
-        column_names = list(Route.__table__.columns)
-    elif selected_table == "Общественный транспорт":
-        column_names = list(PublicTransport.__table__.columns)
-    elif selected_table == "Остановки на маршруте":
-        column_names = list(StopsToRoute.__table__.columns)
 
-    return [column.name for column in column_names]
+@app.context_processor
+def inject_table_labels():
+    return {'table_labels': model_registry.labels()}
 
 
 @app.route('/', methods=['GET'])
@@ -173,6 +571,15 @@ def home():
     return render_template('home.html')
 
 
+# Схема и генерация вынесены из импорта: flask --app app init-db
+if os.environ.get('INIT_DB_ON_STARTUP') == '1':
+    init_db()
+
+# Быстрый старт воркера: кэши и планировщик из снимка, если он совпадает с бд
+if os.environ.get('SNAPSHOT_DIR'):
+    warm_from_snapshot(os.environ['SNAPSHOT_DIR'])
+
 if __name__ == '__main__':
+    init_db()
     app.run(debug=True)
     db_connector.db_disconnect()
@@ -0,0 +1,130 @@
+"""ASGI-версия страниц просмотра таблиц на асинхронных репозиториях.
+
+Запуск: hypercorn asgi:app  (или uvicorn asgi:app --workers N)
+Схема и начальные данные создаются синхронным приложением (app.py).
+Версия только для чтения: сводку маршрутов, поиск, планировщик и ленту /changes
+обновляют обработчики изменений репозиториев app.py, поэтому данные меняются
+только через него.
+"""
+import enum
+
+from flask_csp.csp import csp_default, create_csp_header
+from quart import Quart, render_template, request, jsonify
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from async_repositories import (AsyncStreetRepository, AsyncStopRepository, AsyncBuildingRepository,
+                                AsyncRouteRepository, AsyncPublicTransportRepository, AsyncStopsToRouteRepository)
+from cache import cache_from_env
+from db_backend import create_async_db_engine
+from exceptions import web_exception
+from registry import ModelRegistry
+
+READ_ONLY_MESSAGE = "Здесь данные только просматриваются: изменения вносятся через основное приложение"
+
+app = Quart(__name__)
+csp_policy = create_csp_header(csp_default().read())
+
+engine = create_async_db_engine()
+session_factory = async_sessionmaker(engine, expire_on_commit=False)
+repository_cache = cache_from_env()
+
+model_registry = ModelRegistry()
+model_registry.register("Улица", AsyncStreetRepository(session_factory))
+model_registry.register("Остановка", AsyncStopRepository(session_factory))
+model_registry.register("Здание", AsyncBuildingRepository(session_factory))
+model_registry.register("Маршрут", AsyncRouteRepository(session_factory))
+model_registry.register("Общественный транспорт", AsyncPublicTransportRepository(session_factory))
+model_registry.register("Остановки на маршруте", AsyncStopsToRouteRepository(session_factory))
+for repository in model_registry.repositories():
+    repository.cache = repository_cache
+
+
+@app.after_request
+async def add_csp_header(response):
+    response.headers['Content-Security-Policy'] = csp_policy
+    return response
+
+
+@app.after_serving
+async def dispose_engine():
+    await engine.dispose()
+
+
+@app.context_processor
+async def inject_table_labels():
+    return {'table_labels': model_registry.labels()}
+
+
+def find_columns_name(selected_table: str) -> list[str]:
+    return model_registry.column_names(selected_table)
+
+
+def plain_cell(cell):
+    return str(cell) if isinstance(cell, enum.Enum) else cell
+
+
+@app.route('/', methods=['GET'])
+async def home():
+    return await render_template('home.html')
+
+
+@app.route('/show_tables', methods=['GET', 'POST'])
+async def show_tables():
+    form = await request.form
+    selected_table = form.get('table_selection', 'Улица')
+    column_names = find_columns_name(selected_table)
+    return await render_template('show_tables.html', selected_table=selected_table,
+                                 column_count=len(column_names), column_names=column_names)
+
+
+@app.route('/show_tables/data', methods=['GET'])
+async def show_tables_data():
+    r = model_registry.repository(request.args.get('table', 'Улица'))
+    if r is None:
+        return jsonify({'error': 'Неизвестная таблица'}), 400
+
+    total, filtered, rows = await r.page(max(request.args.get('start', 0, type=int), 0),
+                                         request.args.get('length', 10, type=int),
+                                         request.args.get('order[0][column]', 0, type=int),
+                                         request.args.get('order[0][dir]', 'asc'),
+                                         request.args.get('search[value]', ''))
+    return jsonify({
+        'draw': request.args.get('draw', 0, type=int),
+        'recordsTotal': total,
+        'recordsFiltered': filtered,
+        'data': [[plain_cell(cell) for cell in row] for row in rows],
+    })
+
+
+@app.route('/change_info', methods=['GET', 'POST'])
+async def change_info():
+    form = await request.form
+    selected_table = form.get('table_selection', 'Улица')
+    column_names = find_columns_name(selected_table)
+
+    if request.method == 'POST':
+        s = await post_for_change_info(form)
+        if s is not None:
+            return s
+    return await render_template('change_info.html', selected_table=selected_table, object=column_names,
+                                 input_fields=[])
+
+
+async def post_for_change_info(form):
+    action = form.get('action')
+    selected_table = form.get("selected_table")
+    column_names = find_columns_name(selected_table)
+    r = model_registry.repository(selected_table)
+    if action == 'get_by_id':
+        try:
+            s = await r.fields_list(int(form.get(form.get('id_name'))))
+            if not s:
+                web_exception(Exception("Такого id нет в базе данных"))
+                s = []
+            return await render_template('change_info.html', selected_table=selected_table,
+                                         object=column_names, input_fields=s)
+        except (TypeError, ValueError):
+            web_exception(Exception("Некорректное значение id"))
+    elif action in ['update', 'add', 'delete']:
+        return await render_template('change_info.html', selected_table=selected_table, object=column_names,
+                                     input_fields=[], message=READ_ONLY_MESSAGE)
@@ -0,0 +1,203 @@
+from typing import Generic, TypeVar, Optional, Dict, Any
+
+from sqlalchemy import select, func, or_, cast, String
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import exceptions
+from cache import RepositoryCache
+from db_construction import VERSION, Street, Stop, Building, Route, StopsToRoute, PublicTransport
+from registry import table_info
+from repositories import IRepository, ChangeListener
+
+T = TypeVar('T')
+
+
+class IAsyncRepository(Generic[T]):
+    """Асинхронный вариант IRepository на AsyncSession (asyncpg).
+
+    Каждая операция открывает свою короткую сессию из фабрики, поэтому один
+    экземпляр репозитория можно безопасно использовать из многих корутин.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker, model: T):
+        self.session_factory = session_factory
+        self.model = model
+        self.info = table_info(model)
+        self.change_listeners: list[ChangeListener] = []
+        self.cache: Optional[RepositoryCache] = None
+
+    row_values = IRepository.row_values
+    primary_key_value = IRepository.primary_key_value
+    fix_string_args = IRepository.fix_string_args
+    _notify = IRepository._notify
+    _update_statement = IRepository._update_statement
+    _upsert_statement = IRepository._upsert_statement
+    _insert_statement = IRepository._insert_statement
+    _sync_sequence_statement = IRepository._sync_sequence_statement
+    _split_returning = IRepository._split_returning
+    _delete_statements = IRepository._delete_statements
+
+    async def get(self, entity_id: int) -> Optional[T]:
+        try:
+            async with self.session_factory() as session:
+                return await session.get(self.model, entity_id)
+        except Exception as e:
+            exceptions.db_changing_exception(e)
+            return None
+
+    async def all(self) -> list[list]:
+        try:
+            async with self.session_factory() as session:
+                result = await session.stream(self.info.select_all)
+                return [list(row) async for row in result]
+        except Exception as e:
+            exceptions.db_changing_exception(e)
+            return []
+
+    async def page(self, start: int, length: int, order_column: int = 0, order_dir: str = 'asc',
+                   search: str = '') -> tuple[int, int, list[list]]:
+        try:
+            async with self.session_factory() as session:
+                columns = self.info.columns
+                total = await session.scalar(select(func.count()).select_from(self.model))
+
+                query = self.info.select_all
+                filtered = total
+                if search:
+                    pattern = f"%{search}%"
+                    query = query.where(or_(*(cast(column, String).ilike(pattern) for column in columns)))
+                    filtered = await session.scalar(select(func.count()).select_from(query.subquery()))
+
+                order_by = columns[order_column] if 0 <= order_column < len(columns) else columns[0]
+                order_by = order_by.desc() if order_dir == 'desc' else order_by.asc()
+                query = query.order_by(order_by, self.info.primary_key).offset(start)
+                if length >= 0:
+                    query = query.limit(length)
+
+                return total, filtered, [list(row) for row in await session.execute(query)]
+        except Exception as e:
+            exceptions.db_changing_exception(e)
+            return 0, 0, []
+
+    async def fields_list(self, instance_id: int) -> Optional[list]:
+        instance = await self.get(instance_id)
+        if instance is not None:
+            return list(self.info.values(instance))
+        return None
+
+    async def add_list(self, arg: Dict[str, Any]) -> None:
+        try:
+            pk = self.info.primary_key.name
+            arg.pop(VERSION, None)
+            if arg.get(pk) in (None, ''):
+                arg.pop(pk, None)
+                self.fix_string_args(arg)
+                async with self.session_factory() as session:
+                    row = dict((await session.execute(self._insert_statement(arg))).mappings().one())
+                    await session.commit()
+                self._notify('add', row)
+            else:
+                self.fix_string_args(arg)
+                await self.upsert(arg)
+        except Exception as e:
+            exceptions.db_changing_exception(e)
+
+    async def upsert(self, values: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        try:
+            async with self.session_factory() as session:
+                dialect = session.get_bind().dialect.name
+                old = await self._current_row(session, values[self.info.primary_key.name], lock=True)
+                statement = self._upsert_statement(values, dialect)
+                if statement is not None:
+                    row = dict((await session.execute(statement)).mappings().one())
+                    if old is None and dialect == 'postgresql':
+                        await session.execute(self._sync_sequence_statement())
+                elif old is None:
+                    row = dict((await session.execute(self._insert_statement(values))).mappings().one())
+                else:
+                    _, statement = self._update_statement(values, dialect)
+                    row, _ = self._split_returning((await session.execute(statement)).mappings().one())
+                await session.commit()
+        except Exception as e:
+            exceptions.db_changing_exception(e)
+            return None
+        self._notify('add' if old is None else 'update', row, old)
+        return row
+
+    async def update_list(self, arg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """UPDATE ... WHERE pk AND version RETURNING, как IRepository.update_values."""
+        try:
+            self.fix_string_args(arg)
+            async with self.session_factory() as session:
+                dialect = session.get_bind().dialect.name
+                _id, statement = self._update_statement(arg, dialect)
+                old = None if dialect == 'postgresql' else await self._current_row(session, _id)
+                result = (await session.execute(statement)).mappings().first()
+                if result is None:
+                    current = await self._current_row(session, _id)
+                    if current is None:
+                        raise LookupError(f"Такого id нет в базе данных: {_id}")
+                    raise exceptions.StaleRowError(current)
+                row, returned_old = self._split_returning(result)
+                await session.commit()
+            self._notify('update', row, returned_old or old)
+            return row
+        except exceptions.StaleRowError:
+            raise
+        except Exception as e:
+            exceptions.db_changing_exception(e)
+            return None
+
+    async def _current_row(self, session, entity_id, lock: bool = False) -> Optional[Dict[str, Any]]:
+        query = self.info.select_all.where(self.info.primary_key == entity_id)
+        if lock:
+            query = query.with_for_update()
+        row = (await session.execute(query)).mappings().first()
+        return dict(row) if row is not None else None
+
+    async def delete_by_id(self, id_arg: int) -> Optional[Dict[str, int]]:
+        # Одна команда DELETE; зависимые строки удаляет сама бд (ON DELETE CASCADE)
+        try:
+            counts_statement, delete_statement = self._delete_statements(self.info.primary_key == id_arg)
+            async with self.session_factory() as session:
+                counts = {}
+                if counts_statement is not None:
+                    counts = dict((await session.execute(counts_statement)).mappings().one())
+                rows = [dict(row) for row in (await session.execute(delete_statement)).mappings()]
+                await session.commit()
+        except Exception as e:
+            exceptions.db_changing_exception(e)
+            return None
+        for row in rows:
+            self._notify('delete', row)
+        return {self.model.__tablename__: len(rows), **counts}
+
+
+class AsyncStreetRepository(IAsyncRepository[Street]):
+    def __init__(self, session_factory: async_sessionmaker):
+        super().__init__(session_factory, Street)
+
+
+class AsyncStopRepository(IAsyncRepository[Stop]):
+    def __init__(self, session_factory: async_sessionmaker):
+        super().__init__(session_factory, Stop)
+
+
+class AsyncBuildingRepository(IAsyncRepository[Building]):
+    def __init__(self, session_factory: async_sessionmaker):
+        super().__init__(session_factory, Building)
+
+
+class AsyncRouteRepository(IAsyncRepository[Route]):
+    def __init__(self, session_factory: async_sessionmaker):
+        super().__init__(session_factory, Route)
+
+
+class AsyncStopsToRouteRepository(IAsyncRepository[StopsToRoute]):
+    def __init__(self, session_factory: async_sessionmaker):
+        super().__init__(session_factory, StopsToRoute)
+
+
+class AsyncPublicTransportRepository(IAsyncRepository[PublicTransport]):
+    def __init__(self, session_factory: async_sessionmaker):
+        super().__init__(session_factory, PublicTransport)
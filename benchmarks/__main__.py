@@ -0,0 +1,149 @@
+"""Запуск бенчмарков: python -m benchmarks --url sqlite:///benchmark.db --size small
+
+База по указанному URL пересоздаётся с нуля, поэтому URL задаётся явно.
+Результаты дописываются в JSON-файл; с --compare сравниваются с прошлым запуском.
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from sqlalchemy import make_url
+from sqlalchemy.orm import Session
+
+import db_construction
+from db_backend import create_db_engine
+from cache import LocalCacheBackend
+from benchmarks.city import CITY_SIZES, city_params, generate_city
+from benchmarks.suite import SUITES
+from seeding import seed_workers_for
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Бенчмарки репозиториев и страниц приложения')
+    parser.add_argument('--url', default='sqlite:///benchmark.db', help='база для замеров (будет пересоздана)')
+    parser.add_argument('--size', choices=sorted(CITY_SIZES), default='small')
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--seed-workers', type=int, default=None,
+                        help='потоков заполнения базы (по умолчанию SEED_WORKERS или число ядер; SQLite - 1)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default='', help='запускать только бенчмарки, содержащие подстроку')
+    parser.add_argument('--cache', action='store_true', help='не отключать кэш репозиториев')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', action='store_true', help='сравнить с предыдущим запуском из --output')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое замедление (доля)')
+    args = parser.parse_args(argv)
+
+    url = make_url(args.url)
+    engine = create_db_engine(url)
+    db_construction.DeclarativeBase.metadata.drop_all(engine)
+    db_construction.DeclarativeBase.metadata.create_all(engine)
+
+    params = city_params(args.size, args.scale)
+    phases = {}
+    start = time.perf_counter()
+    with Session(engine) as session:
+        workers = args.seed_workers if args.seed_workers is not None else seed_workers_for(session)
+        city = generate_city(session, args.seed, workers=workers, report=phases, **params)
+    results = {'seed_city': [time.perf_counter() - start]}
+    for table, phase in phases.items():
+        results[f'seed_city.{table}'] = [phase['seconds']]
+    engine.dispose()
+
+    env = _load_app(url, args.cache)
+    env.city = city
+
+    for suite_class in SUITES:
+        suite = suite_class()
+        suite.setup(env)
+        for name in sorted(dir(suite)):
+            full_name = f"{suite_class.__name__}.{name}"
+            if not name.startswith('time_') or args.filter not in full_name:
+                continue
+            bench = getattr(suite, name)
+            bench()
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                bench()
+                timings.append(time.perf_counter() - start)
+            results[full_name] = timings
+
+    run = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'dialect': url.get_backend_name(),
+        'size': args.size, 'scale': args.scale, 'seed': args.seed, 'rows': city,
+        'results': {name: _summary(timings) for name, timings in results.items()},
+    }
+    _print_run(run)
+
+    history = []
+    if os.path.exists(args.output):
+        with open(args.output, encoding='utf-8') as f:
+            history = json.load(f)
+    regressions = _compare(history, run, args.tolerance) if args.compare else []
+    history.append(run)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(history, f, ensure_ascii=False, indent=1)
+    return 1 if regressions else 0
+
+
+def _load_app(url, cache: bool):
+    # Приложение подключается к базе при импорте, поэтому адрес подменяется заранее
+    os.environ['DATABASE_URL'] = url.render_as_string(hide_password=False)
+    import app
+    if not cache:
+        # Кэш ничего не хранит, но версии таблиц по-прежнему растут: на них опираются ETag
+        app.repository_cache.backend = LocalCacheBackend(max_entries=0)
+    # Бенчмарк пишет в базу только из этого процесса, так что ETag по локальным версиям верны
+    app.repository_cache.backend.shared = True
+    return app
+
+
+def _summary(timings: list[float]) -> dict[str, float]:
+    return {'min': min(timings), 'median': statistics.median(timings), 'mean': statistics.fmean(timings),
+            'repeat': len(timings)}
+
+
+def _compare(history: list, run: dict, tolerance: float) -> list[str]:
+    previous = next((old for old in reversed(history)
+                     if (old['dialect'], old['size'], old['scale']) == (run['dialect'], run['size'], run['scale'])),
+                    None)
+    if previous is None:
+        print('Нет предыдущего запуска с теми же параметрами для сравнения')
+        return []
+    regressions = []
+    for name, summary in run['results'].items():
+        old = previous['results'].get(name)
+        if old is None:
+            continue
+        ratio = summary['median'] / old['median'] if old['median'] else 1
+        mark = 'SLOWER' if ratio > 1 + tolerance else ''
+        print(f"{name:50} {ratio:6.2f}x {mark}")
+        if mark:
+            regressions.append(name)
+    return regressions
+
+
+def _print_run(run: dict) -> None:
+    print(f"{run['dialect']} size={run['size']} scale={run['scale']} rows={run['rows']}")
+    for name, summary in run['results'].items():
+        print(f"{name:50} median {summary['median'] * 1000:10.2f} ms   min {summary['min'] * 1000:10.2f} ms")
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return ''
+
+
+if __name__ == '__main__':
+    sys.exit(main())
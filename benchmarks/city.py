@@ -0,0 +1,123 @@
+"""Генератор синтетического города для нагрузочных тестов.
+
+Все случайные решения принимаются генератором random.Random(seed), поэтому при
+одинаковых параметрах получается один и тот же город. Базу нужно заполнять с нуля.
+"""
+import random
+from typing import Any, Dict
+
+from sqlalchemy import select
+
+from db_construction import StreetType, TransportType, BuildingType, RouteType, Street, Stop, Building, Route, \
+    StopsToRoute, PublicTransport, DeclarativeBase
+from db_interactions import bulk_add
+from seeding import run_phases
+
+DISTRICTS = ['Central', 'Soviet', 'North', 'South', 'Left Bank', 'Industrial']
+LETTERS = [chr(i) for i in range(ord('А'), ord('Я') + 1)]
+
+# Готовые размеры города; scale умножает улицы, а значит и остановки и здания
+CITY_SIZES = {
+    'tiny': dict(streets=20, stops_per_street=2, buildings_per_street=50, routes=10, stops_per_route=8,
+                 vehicles_per_route=2),
+    'small': dict(streets=100, stops_per_street=3, buildings_per_street=100, routes=40, stops_per_route=15,
+                  vehicles_per_route=3),
+    'medium': dict(streets=500, stops_per_street=4, buildings_per_street=200, routes=150, stops_per_route=25,
+                   vehicles_per_route=4),
+    'large': dict(streets=2000, stops_per_street=5, buildings_per_street=500, routes=500, stops_per_route=40,
+                  vehicles_per_route=5),
+}
+
+
+def city_params(size: str = 'small', scale: int = 1, **overrides) -> Dict[str, int]:
+    params = dict(CITY_SIZES[size])
+    params['streets'] *= scale
+    params['routes'] *= scale
+    params.update(overrides)
+    return params
+
+
+def generate_city(session, seed: int = 0, streets: int = 100, stops_per_street: int = 3,
+                  buildings_per_street: int = 100, routes: int = 40, stops_per_route: int = 15,
+                  vehicles_per_route: int = 3, workers: int = 1, report: Dict[str, Any] = None) -> Dict[str, int]:
+    """Заполняет пустую базу городом заданного размера и возвращает число строк по таблицам.
+
+    Фазы идут в workers потоков (seeding.run_phases); в report, если он передан,
+    записывается время и скорость каждой фазы.
+    """
+    # У каждой фазы свой генератор: порядок выполнения фаз в потоках не влияет на город
+    def rng(table):
+        return random.Random(f"{seed}-{table}")
+
+    def street_parts(session):
+        street_rng = rng('street')
+        return [[{'street_name': f"Улица {i}", 'street_type': street_rng.choice(list(StreetType)),
+                  'district': street_rng.choice(DISTRICTS)}
+                 for i in range(1, streets + 1)]]
+
+    def stop_parts(session):
+        stop_rng = rng('stop')
+        return [[{'stop_name': f"Остановка {street_id}-{k}", 'stop_type': stop_rng.choice(list(TransportType)),
+                  'street_id': street_id} for k in range(1, stops_per_street + 1)]
+                for street_id in _ids(session, Street.street_id)]
+
+    def building_parts(session):
+        building_rng = rng('building')
+        building_types = list(BuildingType)
+        stops_by_street = _stops_by_street(session)
+        # Дом обслуживает одна из остановок его улицы; здания улицы - отдельная часть
+        return [[{'building_number': number, 'building_type': building_rng.choice(building_types),
+                  'street_id': street_id, 'stop_id': building_rng.choice(stops_by_street[street_id])}
+                 for number in range(1, buildings_per_street + 1)]
+                for street_id in _ids(session, Street.street_id)]
+
+    def route_parts(session):
+        route_rng = rng('route')
+        return [[{'route_number': number, 'route_type': route_rng.choice(list(RouteType))}
+                 for number in range(1, routes + 1)]]
+
+    def stops_to_route_parts(session):
+        membership_rng = rng('stops_to_route')
+        stop_ids = [stop_id for ids in _stops_by_street(session).values() for stop_id in ids]
+        return [[{'route_id': route_id, 'stop_id': stop_id, 'stop_num_in_route': position}
+                 for position, stop_id in enumerate(
+                     membership_rng.sample(stop_ids, min(stops_per_route, len(stop_ids))), start=1)]
+                for route_id in _ids(session, Route.route_id)]
+
+    def transport_parts(session):
+        transport_rng = rng('public_transport')
+        route_ids = _ids(session, Route.route_id)
+        return [[{'transport_number': _transport_number(index), 'route_id': route_id,
+                  'transport_type': transport_rng.choice(list(TransportType))}
+                 for index, route_id in enumerate(route_id for route_id in route_ids
+                                                  for _ in range(vehicles_per_route))]]
+
+    phases = {Street: street_parts, Stop: stop_parts, Building: building_parts, Route: route_parts,
+              StopsToRoute: stops_to_route_parts, PublicTransport: transport_parts}
+    phase_report = run_phases(session, DeclarativeBase.metadata, phases, bulk_add, workers)
+    session.commit()
+    if report is not None:
+        report.update(phase_report)
+    return {table: phase['rows'] for table, phase in phase_report.items()}
+
+
+def _ids(session, column) -> list[int]:
+    return session.scalars(select(column).order_by(column)).all()
+
+
+def _stops_by_street(session) -> Dict[int, list[int]]:
+    stops_by_street = {}
+    for stop_id, street_id in session.execute(select(Stop.stop_id, Stop.street_id).order_by(Stop.stop_id)):
+        stops_by_street.setdefault(street_id, []).append(stop_id)
+    return stops_by_street
+
+
+def _transport_number(index: int) -> str:
+    # Уникальный госномер вида А123БВ по порядковому номеру машины
+    digits = index % 1000
+    index //= 1000
+    letters = []
+    for _ in range(3):
+        letters.append(LETTERS[index % len(LETTERS)])
+        index //= len(LETTERS)
+    return f"{letters[0]}{digits:03d}{letters[1]}{letters[2]}"
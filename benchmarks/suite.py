@@ -0,0 +1,85 @@
+"""Замеры в стиле asv: каждый метод time_* класса - отдельный бенчмарк.
+
+Перед замерами вызывается setup(env), где env - загруженный модуль app
+с базой, заполненной генератором города.
+"""
+import random
+
+
+class RepositorySuite:
+    def setup(self, env):
+        self.env = env
+        self.rng = random.Random(1)
+        # Удаление идёт с последних улиц, а чтения берут id из первой половины города
+        self.building_ids = list(range(1, env.city['building'] // 2 + 1))
+        self.stop_ids = list(range(1, env.city['stop'] // 2 + 1))
+        self.streets_to_delete = list(range(env.city['street'] // 2 + 1, env.city['street'] + 1))
+        self.sample_size = min(100, len(self.building_ids), len(self.stop_ids))
+
+    def time_all_streets(self):
+        self.env.street_repository.all()
+
+    def time_all_buildings(self):
+        self.env.building_repository.all()
+
+    def time_get_building(self):
+        repository = self.env.building_repository
+        for building_id in self.rng.sample(self.building_ids, self.sample_size):
+            repository.get(building_id)
+        repository.session.remove()
+
+    def time_fields_list_stop(self):
+        repository = self.env.stop_repository
+        for stop_id in self.rng.sample(self.stop_ids, self.sample_size):
+            repository.fields_list(stop_id)
+        repository.session.remove()
+
+    def time_update_list_stop(self):
+        repository = self.env.stop_repository
+        stop_id = self.rng.choice(self.stop_ids)
+        fields = repository.fields_list(stop_id)
+        if fields is not None:
+            repository.update_list({'stop_id': stop_id, 'stop_name': fields[1], 'stop_type': str(fields[2]),
+                                    'street_id': str(fields[3])})
+        repository.session.remove()
+
+    def time_delete_street_cascade(self):
+        # Каждый повтор удаляет следующую улицу вместе с её остановками и зданиями
+        if self.streets_to_delete:
+            self.env.street_repository.delete_by_id(self.streets_to_delete.pop())
+        self.env.street_repository.session.remove()
+
+
+class AppSuite:
+    def setup(self, env):
+        self.client = env.app.test_client()
+        self.window = {'table': 'Здание', 'start': 1000, 'length': 50}
+        self.etag = self.client.get('/show_tables/data', query_string=self.window).headers.get('ETag', '')
+
+    def time_show_tables_page(self):
+        self.client.post('/show_tables', data={'table_selection': 'Здание'})
+
+    def time_show_tables_data_window(self):
+        self.client.get('/show_tables/data', query_string={'table': 'Здание', 'start': 1000, 'length': 50,
+                                                           'order[0][column]': 1, 'order[0][dir]': 'desc'})
+
+    def time_show_tables_data_not_modified(self):
+        # Повторный просмотр с ETag из прошлого ответа: 304 без запросов к базе
+        self.client.get('/show_tables/data', query_string=self.window, headers={'If-None-Match': self.etag})
+
+    def time_show_tables_data_search(self):
+        self.client.get('/show_tables/data', query_string={'table': 'Остановка', 'length': 50,
+                                                           'search[value]': '7-'})
+
+    def time_search_prefix(self):
+        self.client.get('/search', query_string={'q': 'Остановка 1'})
+
+    def time_search_typo(self):
+        self.client.get('/search', query_string={'q': 'Астановка 12-'})
+
+    def time_change_info_get_by_id(self):
+        self.client.post('/change_info', data={'action': 'get_by_id', 'selected_table': 'Здание',
+                                               'id_name': 'building_id', 'building_id': '1'})
+
+
+SUITES = [RepositorySuite, AppSuite]
@@ -0,0 +1,221 @@
+import os
+import pickle
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Optional
+
+from exceptions import exception_message
+
+# Признак промаха, отличный от закэшированного None
+MISSING = object()
+
+
+class CacheBackend(ABC):
+    # Общий ли кэш для всех процессов: иначе ETag по его версиям живут не дольше TTL
+    shared = False
+
+    @abstractmethod
+    def get(self, key: str) -> Any:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: Any) -> None:
+        ...
+
+    @abstractmethod
+    def incr(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    def counter(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    def stamp(self, key: str, value: Optional[float] = None) -> float:
+        """Запоминает время (по умолчанию текущее) без срока жизни, как счётчики."""
+
+    @abstractmethod
+    def stamped(self, key: str) -> Optional[float]:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+
+class LocalCacheBackend(CacheBackend):
+    """Кэш в памяти процесса: LRU-вытеснение по числу записей и TTL."""
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._counters: dict[str, int] = {}
+        self._stamps: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return MISSING
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key: str) -> int:
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def stamp(self, key: str, value: Optional[float] = None) -> float:
+        with self._lock:
+            self._stamps[key] = time.time() if value is None else value
+            return self._stamps[key]
+
+    def stamped(self, key: str) -> Optional[float]:
+        with self._lock:
+            return self._stamps.get(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCacheBackend(CacheBackend):
+    """Общий для всех воркеров кэш в Redis-совместимом сервере (Redis, KeyDB, Dragonfly).
+
+    Вытеснение LRU настраивается на сервере (maxmemory-policy allkeys-lru),
+    TTL задаётся при записи.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, ttl: float = 300, prefix: str = 'roads:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def get(self, key: str) -> Any:
+        value = self.client.get(self.prefix + key)
+        return MISSING if value is None else pickle.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def incr(self, key: str) -> int:
+        return self.client.incr(self.prefix + key)
+
+    def counter(self, key: str) -> int:
+        value = self.client.get(self.prefix + key)
+        return int(value) if value is not None else 0
+
+    def stamp(self, key: str, value: Optional[float] = None) -> float:
+        value = time.time() if value is None else value
+        self.client.set(self.prefix + key, value)
+        return value
+
+    def stamped(self, key: str) -> Optional[float]:
+        value = self.client.get(self.prefix + key)
+        return float(value) if value is not None else None
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class RepositoryCache:
+    """Сквозной кэш чтений репозиториев.
+
+    Ключ записи содержит таблицу, версию таблицы и id. Любая запись в таблицу
+    увеличивает её версию, поэтому старые записи больше не находятся и
+    вытесняются LRU/TTL.
+    """
+
+    def __init__(self, backend: CacheBackend, max_cached_rows: int = 5000):
+        self.backend = backend
+        self.max_cached_rows = max_cached_rows
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Начало отсчёта версий: меняется, когда счётчики версий начинаются заново
+        self.epoch = self._epoch()
+
+    def version(self, table: str) -> int:
+        return self.backend.counter('version:' + table)
+
+    def invalidate(self, table: str) -> None:
+        # Вызывается после фиксации записи: ошибка кэша не должна выдавать её за неудачную
+        try:
+            self.backend.incr('version:' + table)
+            self.backend.stamp('modified:' + table)
+        except Exception as e:
+            exception_message("Ошибка записи в кэш", e)
+
+    def modified(self, table: str) -> float:
+        """Время последней записи в таблицу (или начала отсчёта версий)."""
+        try:
+            return self.backend.stamped('modified:' + table) or self.epoch
+        except Exception as e:
+            exception_message("Ошибка чтения кэша", e)
+            return time.time()
+
+    def _epoch(self) -> float:
+        try:
+            return self.backend.stamped('epoch') or self.backend.stamp('epoch')
+        except Exception as e:
+            exception_message("Ошибка чтения кэша", e)
+            return time.time()
+
+    def key(self, table: str, kind: str, item_id: Any = '') -> str:
+        return f"{table}:v{self.version(table)}:{kind}:{item_id}"
+
+    def get(self, key: str) -> Any:
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            exception_message("Ошибка чтения кэша", e)
+            value = MISSING
+        with self._lock:
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        try:
+            self.backend.set(key, value)
+        except Exception as e:
+            exception_message("Ошибка записи в кэш", e)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def cache_from_env() -> RepositoryCache:
+    ttl = float(os.environ.get('CACHE_TTL', 300))
+    if os.environ.get('CACHE_BACKEND', 'local') == 'redis':
+        backend = RedisCacheBackend(os.environ.get('CACHE_URL', 'redis://localhost:6379/0'), ttl)
+    else:
+        backend = LocalCacheBackend(int(os.environ.get('CACHE_MAX_ENTRIES', 10000)), ttl)
+    return RepositoryCache(backend, int(os.environ.get('CACHE_MAX_ROWS', 5000)))
@@ -0,0 +1,192 @@
+"""Лента изменений строк для Server-Sent Events.
+
+Репозитории публикуют события через обработчики изменений (listener). В
+PostgreSQL событие уходит в канал NOTIFY и доходит до всех воркеров, которые
+его слушают, а id событий берутся из общей последовательности, так что
+Last-Event-ID годится для любого воркера. В остальных бд работает шина внутри
+процесса со своими id: /changes там работает только с одним воркером.
+"""
+import enum
+import json
+import os
+import queue
+import select
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterator, Optional
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.types import Text
+
+from exceptions import exception_message
+
+CHANNEL = 'roads_changes'
+# Сколько секунд держать одно SSE-соединение: в синхронном сервере оно занимает поток воркера
+stream_lifetime = float(os.environ.get('CHANGES_STREAM_SECONDS', 60))
+
+
+class ChangeFeed:
+    """Шина событий внутри процесса с коротким буфером для переподключений (Last-Event-ID)."""
+
+    def __init__(self, history: int = 1000):
+        self._events: deque[Dict[str, Any]] = deque(maxlen=history)
+        self._last_id = 0
+        self._condition = threading.Condition()
+
+    def listener(self, table: str, dependents: tuple[str, ...] = ()):
+        """Обработчик изменений репозитория, публикующий события таблицы table.
+
+        Удаление каскадно затрагивает таблицы dependents: для них публикуется 'reload'.
+        """
+        def publish(action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]]) -> None:
+            self.publish(table, action, row)
+            if action == 'delete':
+                for dependent in dependents:
+                    self.publish(dependent, 'reload', {})
+        return publish
+
+    def publish(self, table: str, action: str, row: Dict[str, Any]) -> None:
+        self._append({'table': table, 'action': action, 'row': {key: _plain(value) for key, value in row.items()}})
+
+    def stream(self, tables: Optional[set[str]] = None, last_id: Optional[int] = None,
+               keepalive: float = 15, lifetime: Optional[float] = None) -> Iterator[Optional[Dict[str, Any]]]:
+        """События после last_id (по умолчанию - только новые) для таблиц tables.
+
+        Раз в keepalive секунд без событий отдаёт None, чтобы соединение не закрылось.
+        Через lifetime секунд поток заканчивается: клиент переподключится с Last-Event-ID.
+        """
+        deadline = None if lifetime is None else time.monotonic() + lifetime
+        with self._condition:
+            position = self._start_position(last_id)
+        while deadline is None or time.monotonic() < deadline:
+            timeout = keepalive if deadline is None else min(keepalive, max(deadline - time.monotonic(), 0))
+            with self._condition:
+                if self._last_id <= position:
+                    self._condition.wait(timeout)
+                events = [event for event in self._events if event['id'] > position]
+                position = max(position, self._last_id)
+            if not events:
+                yield None
+            for event in events:
+                if tables is None or event['table'] in tables:
+                    yield event
+
+    def close(self) -> None:
+        pass
+
+    def _start_position(self, last_id: Optional[int]) -> int:
+        # id после перезапуска процесса начинаются заново: старый Last-Event-ID не годится
+        return self._last_id if last_id is None or last_id > self._last_id else last_id
+
+    def _append(self, event: Dict[str, Any], event_id: Optional[int] = None) -> None:
+        with self._condition:
+            self._last_id = self._last_id + 1 if event_id is None else event_id
+            event['id'] = self._last_id
+            self._events.append(event)
+            self._condition.notify_all()
+
+
+class PostgresChangeFeed(ChangeFeed):
+    """События публикуются через pg_notify и принимаются фоновым потоком LISTEN.
+
+    Так изменения, сделанные любым воркером, видят подписчики всех воркеров.
+    События отправляет фоновый поток: всё, что накопилось (например, строки одной
+    пачки или каскадного удаления), уходит одной командой по одному соединению.
+    id события берётся из последовательности в бд и приходит в начале NOTIFY;
+    отправка идёт под общей блокировкой, поэтому события приходят по возрастанию id.
+    """
+
+    _SEQUENCE = text(f"CREATE SEQUENCE IF NOT EXISTS {CHANNEL}_id_seq")
+    _LOCK = text(f"SELECT pg_advisory_xact_lock(hashtext('{CHANNEL}'))")
+    _NOTIFY = text(f"SELECT pg_notify('{CHANNEL}', nextval('{CHANNEL}_id_seq') || ' ' || payload) "
+                   f"FROM unnest(:payloads) AS payload").bindparams(bindparam('payloads', type_=ARRAY(Text)))
+
+    def __init__(self, engine, history: int = 1000):
+        super().__init__(history)
+        self.engine = engine
+        self._stopped = threading.Event()
+        self._outbox: queue.SimpleQueue[str] = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._listen, name='change-feed', daemon=True)
+        self._thread.start()
+        self._sender = threading.Thread(target=self._send, name='change-feed-notify', daemon=True)
+        self._sender.start()
+
+    def publish(self, table: str, action: str, row: Dict[str, Any]) -> None:
+        self._outbox.put(json.dumps({'table': table, 'action': action,
+                                     'row': {key: _plain(value) for key, value in row.items()}},
+                                    ensure_ascii=False))
+
+    def close(self) -> None:
+        self._stopped.set()
+
+    def _start_position(self, last_id: Optional[int]) -> int:
+        # id общие для всех воркеров: Last-Event-ID впереди этого воркера - события, которых он ещё не получил
+        return self._last_id if last_id is None else last_id
+
+    def _send(self) -> None:
+        sequence_ready = False
+        while not self._stopped.is_set():
+            try:
+                payloads = [self._outbox.get(timeout=1)]
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    payloads.append(self._outbox.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.engine.connect() as connection:
+                    if not sequence_ready:
+                        connection.execute(self._SEQUENCE)
+                        connection.commit()
+                        sequence_ready = True
+                    connection.execute(self._LOCK)
+                    connection.execute(self._NOTIFY, {'payloads': payloads})
+                    connection.commit()
+            except Exception as e:
+                exception_message("Ошибка публикации изменений", e)
+
+    def _listen(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                raw = self.engine.raw_connection()
+                try:
+                    connection = raw.driver_connection
+                    connection.autocommit = True
+                    connection.cursor().execute(f'LISTEN {CHANNEL}')
+                    while not self._stopped.is_set():
+                        if select.select([connection], [], [], 5) == ([], [], []):
+                            continue
+                        connection.poll()
+                        while connection.notifies:
+                            notify = connection.notifies.pop(0)
+                            event_id, _, payload = notify.payload.partition(' ')
+                            self._append(json.loads(payload), int(event_id))
+                finally:
+                    raw.invalidate()
+            except Exception as e:
+                exception_message("Ошибка подписки на изменения", e)
+                self._stopped.wait(5)
+
+
+def change_feed_for(engine) -> ChangeFeed:
+    if engine is not None and engine.dialect.name == 'postgresql' and engine.dialect.driver == 'psycopg2':
+        return PostgresChangeFeed(engine)
+    return ChangeFeed()
+
+
+def sse_lines(events: Iterator[Optional[Dict[str, Any]]]) -> Iterator[str]:
+    """Поток событий в формате text/event-stream."""
+    yield 'retry: 3000\n\n'
+    for event in events:
+        if event is None:
+            yield ': keepalive\n\n'
+        else:
+            yield f"id: {event['id']}\nevent: change\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def _plain(value):
+    return str(value) if isinstance(value, enum.Enum) else value
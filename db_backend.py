@@ -0,0 +1,127 @@
+"""Выбор и настройка бд: сервер PostgreSQL или встроенная SQLite.
+
+Адрес бд берётся по порядку из:
+  DATABASE_URL - любой адрес SQLAlchemy, например sqlite:////var/lib/roads/roads.db;
+  файла настроек DB_CONFIG (JSON): {"url": ..., "engine": {...}, "sqlite": {...}},
+    где engine дополняет ENGINE_OPTIONS, а sqlite - SQLITE_PRAGMAS;
+  DATABASE из db_construction.py.
+Адрес sqlite:// (или sqlite:///:memory:) - общая бд в памяти для тестов: одно
+соединение на все потоки (StaticPool), живёт до закрытия движка.
+"""
+import json
+import os
+from typing import Any, Dict
+
+from sqlalchemy import create_engine, event, make_url, text, URL
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from db_construction import DATABASE, ENGINE_OPTIONS
+
+# Настройки файловой SQLite: WAL пускает читателей параллельно с писателем,
+# synchronous=NORMAL в режиме WAL не теряет целостность при сбое процесса
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    # Отрицательное значение - размер в КиБ
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -64 * 1024)),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+    'temp_store': 'MEMORY',
+    # Без этого SQLite не проверяет внешние ключи
+    'foreign_keys': 'ON',
+}
+
+# Параметры пула, которые не применимы к одному общему соединению StaticPool;
+# пересоздание соединения потеряло бы бд в памяти
+_STATIC_POOL_IGNORED = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+
+
+def load_config() -> Dict[str, Any]:
+    path = os.environ.get('DB_CONFIG')
+    if not path:
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def database_url() -> URL:
+    if os.environ.get('DATABASE_URL'):
+        return make_url(os.environ['DATABASE_URL'])
+    config = load_config()
+    if config.get('url'):
+        return make_url(config['url'])
+    return URL(**DATABASE)
+
+
+def is_memory(url: URL) -> bool:
+    return url.get_backend_name() == 'sqlite' and (url.database in (None, '', ':memory:')
+                                                   or url.query.get('mode') == 'memory')
+
+
+def engine_options(url: URL, **overrides) -> Dict[str, Any]:
+    options = dict(ENGINE_OPTIONS, **load_config().get('engine', {}))
+    options.update(overrides)
+    if is_memory(url):
+        for option in _STATIC_POOL_IGNORED:
+            options.pop(option, None)
+        options['poolclass'] = StaticPool
+        options['connect_args'] = dict(options.get('connect_args', {}), check_same_thread=False)
+    return options
+
+
+def create_db_engine(url=None, **overrides):
+    """Движок для url (по умолчанию database_url()) с настройками бэкенда."""
+    url = database_url() if url is None else make_url(url)
+    engine = create_engine(url, **engine_options(url, **overrides))
+    _listen_sqlite_pragmas(engine, url)
+    return engine
+
+
+def create_async_db_engine(url=None, **overrides):
+    """Асинхронный движок (asyncpg или aiosqlite) с теми же настройками бэкенда."""
+    url = async_url(database_url() if url is None else make_url(url))
+    engine = create_async_engine(url, **engine_options(url, **overrides))
+    # События соединений есть только у синхронного движка внутри асинхронного
+    _listen_sqlite_pragmas(engine.sync_engine, url)
+    return engine
+
+
+def async_url(url: URL) -> URL:
+    """Тот же адрес с асинхронным драйвером (asyncpg или aiosqlite)."""
+    backend = url.get_backend_name()
+    if backend == 'postgresql':
+        return url.set(drivername='postgresql+asyncpg')
+    if backend == 'sqlite':
+        return url.set(drivername='sqlite+aiosqlite')
+    return url
+
+
+def check_connection(engine) -> None:
+    """Сразу проверяет, что бд доступна, вместо ошибки на первом запросе."""
+    try:
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+    except Exception as e:
+        raise RuntimeError(f"Бд {engine.url.render_as_string(hide_password=True)} недоступна: {e}") from e
+
+
+def _listen_sqlite_pragmas(engine, url: URL) -> None:
+    if url.get_backend_name() == 'sqlite':
+        pragmas = dict(SQLITE_PRAGMAS, **load_config().get('sqlite', {}))
+        if is_memory(url):
+            # Журнал бд в памяти всегда в памяти, отображать в память нечего
+            pragmas.pop('journal_mode')
+            pragmas.pop('mmap_size')
+        event.listen(engine, 'connect', _sqlite_pragmas(pragmas))
+
+
+def _sqlite_pragmas(pragmas: Dict[str, Any]):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+    return on_connect
@@ -1,8 +1,9 @@
 import enum
+import os
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Enum, \
+from sqlalchemy import Column, Integer, String, ForeignKey, Enum, DateTime, \
     UniqueConstraint, \
-    PrimaryKeyConstraint, CheckConstraint
+    PrimaryKeyConstraint, CheckConstraint, Index, DDL, event
 from sqlalchemy.orm import declarative_base, relationship
 
 DATABASE = {
@@ -16,7 +17,19 @@ DATABASE = {
     }
 }
 
+# Параметры пула соединений, переопределяются переменными окружения
+ENGINE_OPTIONS = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+}
+
 DeclarativeBase = declarative_base()
+# Расширение для триграммных индексов поиска
+event.listen(DeclarativeBase.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
 
 
 class StreetType(enum.Enum):
@@ -48,20 +61,31 @@ long_string = 300
 middle_string = 100
 short_string = 50
 
+# Номер версии строки для оптимистичной блокировки: UPDATE ... WHERE version = :v
+VERSION = 'version'
+
 
 class Street(DeclarativeBase):
     __tablename__ = 'street'
 
     street_id = Column(Integer, primary_key=True, autoincrement=True)
     street_name = Column(String(middle_string), nullable=False)
-    street_type = Column(Enum(StreetType), nullable=False)
+    # create_constraint: в бд без типа ENUM (SQLite) допустимые значения проверяет CHECK
+    street_type = Column(Enum(StreetType, create_constraint=True), nullable=False)
     district = Column(String(middle_string), nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     __table_args__ = (
         UniqueConstraint('street_name', 'street_type'),
+        # Триграммный индекс для поиска по части названия и с опечатками (search.py)
+        Index('ix_street_name_trgm', 'street_name', postgresql_using='gin',
+              postgresql_ops={'street_name': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
     )
 
-    stops = relationship("Stop", back_populates="street", cascade="all, delete-orphan")
-    buildings = relationship("Building", back_populates="street", cascade="all, delete-orphan")
+    # Зависимые строки удаляет сама бд (ON DELETE CASCADE): passive_deletes не даёт ORM их загружать
+    stops = relationship("Stop", back_populates="street", cascade="all, delete-orphan",
+                         passive_deletes=True)
+    buildings = relationship("Building", back_populates="street", cascade="all, delete-orphan",
+                             passive_deletes=True)
 
 
 class Stop(DeclarativeBase):
@@ -69,12 +93,19 @@ class Stop(DeclarativeBase):
 
     stop_id = Column(Integer, primary_key=True, autoincrement=True)
     stop_name = Column(String(long_string), nullable=False, unique=True)
-    stop_type = Column(Enum(TransportType), nullable=False)
-    street_id = Column(Integer, ForeignKey('street.street_id'), nullable=False)
+    stop_type = Column(Enum(TransportType, create_constraint=True), nullable=False)
+    street_id = Column(Integer, ForeignKey('street.street_id', ondelete='CASCADE'), nullable=False, index=True)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    __table_args__ = (
+        Index('ix_stop_name_trgm', 'stop_name', postgresql_using='gin',
+              postgresql_ops={'stop_name': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+    )
 
     street = relationship("Street", back_populates="stops")
-    buildings = relationship("Building", back_populates="stop", cascade="all, delete-orphan")
-    stops_to_routes = relationship("StopsToRoute", back_populates="stop", cascade="all, delete-orphan")
+    buildings = relationship("Building", back_populates="stop", cascade="all, delete-orphan",
+                             passive_deletes=True)
+    stops_to_routes = relationship("StopsToRoute", back_populates="stop", cascade="all, delete-orphan",
+                                   passive_deletes=True)
 
 
 class Building(DeclarativeBase):
@@ -82,9 +113,10 @@ class Building(DeclarativeBase):
 
     building_id = Column(Integer, primary_key=True, autoincrement=True)
     building_number = Column(Integer, nullable=False)
-    building_type = Column(Enum(BuildingType), nullable=False)
-    street_id = Column(Integer, ForeignKey('street.street_id'), nullable=False)
-    stop_id = Column(Integer, ForeignKey('stop.stop_id'), nullable=False)
+    building_type = Column(Enum(BuildingType, create_constraint=True), nullable=False)
+    street_id = Column(Integer, ForeignKey('street.street_id', ondelete='CASCADE'), nullable=False, index=True)
+    stop_id = Column(Integer, ForeignKey('stop.stop_id', ondelete='CASCADE'), nullable=False, index=True)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     __table_args__ = (
         UniqueConstraint('building_number', 'street_id'),
         CheckConstraint('building_number > 0'),
@@ -99,24 +131,32 @@ class Route(DeclarativeBase):
 
     route_id = Column(Integer, primary_key=True, autoincrement=True)
     route_number = Column(Integer, unique=True, nullable=False)
-    route_type = Column(Enum(RouteType), nullable=False)
+    route_type = Column(Enum(RouteType, create_constraint=True), nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     __table_args__ = (
         CheckConstraint('route_number > 0'),
     )
 
-    stops_to_routes = relationship("StopsToRoute", back_populates="route", cascade="all, delete-orphan")
-    public_transports = relationship("PublicTransport", back_populates="route", cascade="all, delete-orphan")
+    stops_to_routes = relationship("StopsToRoute", back_populates="route", cascade="all, delete-orphan",
+                                   passive_deletes=True)
+    public_transports = relationship("PublicTransport", back_populates="route", cascade="all, delete-orphan",
+                                     passive_deletes=True)
 
 class StopsToRoute(DeclarativeBase):
     __tablename__ = 'stops_to_route'
 
     stops_to_route_id = Column(Integer, primary_key=True, autoincrement=True)
-    route_id = Column(Integer, ForeignKey('route.route_id'))
-    stop_id = Column(Integer, ForeignKey('stop.stop_id'))
+    route_id = Column(Integer, ForeignKey('route.route_id', ondelete='CASCADE'))
+    stop_id = Column(Integer, ForeignKey('stop.stop_id', ondelete='CASCADE'), index=True)
     stop_num_in_route = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     __table_args__ = (
         UniqueConstraint('route_id', 'stop_id'),
         UniqueConstraint('route_id', 'stop_num_in_route'),
+        # Покрывающий индекс для обхода маршрута по порядку остановок без чтения таблицы
+        # В других бд INCLUDE нет, и индекс повторял бы уникальное ограничение выше
+        Index('ix_stops_to_route_route_order', 'route_id', 'stop_num_in_route',
+              postgresql_include=['stop_id']).ddl_if(dialect='postgresql'),
     )
 
     route = relationship("Route", back_populates="stops_to_routes")
@@ -128,7 +168,31 @@ class PublicTransport(DeclarativeBase):
 
     transport_id = Column(Integer, primary_key=True, autoincrement=True)
     transport_number = Column(String(6), unique=True, nullable=False)
-    route_id = Column(Integer, ForeignKey('route.route_id'), nullable=False)
-    transport_type = Column(Enum(TransportType), nullable=False)
+    route_id = Column(Integer, ForeignKey('route.route_id', ondelete='CASCADE'), nullable=False, index=True)
+    transport_type = Column(Enum(TransportType, create_constraint=True), nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    route = relationship("Route", back_populates="public_transports")
+
 
-    route = relationship("Route", back_populates="public_transports")
\ No newline at end of file
+class SeedState(DeclarativeBase):
+    __tablename__ = 'seed_state'
+
+    seed_name = Column(String(short_string), primary_key=True)
+    checksum = Column(String(64), nullable=False)
+    seeded_at = Column(DateTime, nullable=False)
+
+
+class RouteTimeline(DeclarativeBase):
+    # Денормализованный порядок остановок маршрута, поддерживается route_timeline.py
+    __tablename__ = 'route_timeline'
+
+    route_id = Column(Integer, primary_key=True)
+    stop_num_in_route = Column(Integer, primary_key=True)
+    route_number = Column(Integer, nullable=False, index=True)
+    stop_id = Column(Integer, nullable=False, index=True)
+    stop_name = Column(String(long_string), nullable=False)
+    street_id = Column(Integer, nullable=False, index=True)
+    street_name = Column(String(middle_string), nullable=False)
+    district = Column(String(middle_string), nullable=False)
+    vehicle_count = Column(Integer, nullable=False)
@@ -1,120 +1,277 @@
+import datetime
+import hashlib
+import os
 import random
+from functools import partial
 
-from sqlalchemy import select
+from sqlalchemy import insert, select, delete, text
+from sqlalchemy.dialects import postgresql, sqlite
 
 from db_construction import StreetType, TransportType, BuildingType, RouteType, Street, Stop, Building, Route, \
-    StopsToRoute, PublicTransport
+    StopsToRoute, PublicTransport, SeedState, DeclarativeBase
 from exceptions import db_changing_exception, exception_message
+from seeding import run_phases, seed_workers_for
 
 stops_number = 20
 transports_number = 12
 routs_number = 15
 
-
-def generate_db(session):
+# Множитель объёма генерируемых зданий и остановок (для нагрузочного тестирования)
+seed_scale = int(os.environ.get('SEED_SCALE', 1))
+# Количество строк в одном INSERT ... VALUES
+batch_size = 10000
+
+
+def seed_db(session, mode: str = 'auto', scale: int = None) -> str:
+    """Заполняет базу, если это нужно, и возвращает 'skipped', 'generated' или 'reconciled'.
+
+    Контрольная сумма файлов и масштаба хранится в seed_state. В режиме auto
+    база с совпадающей суммой не трогается, пустая база генерируется целиком,
+    а непустая - сверяется: добавляются только недостающие строки.
+    Режим reconcile выполняет сверку принудительно, а force очищает сгенерированные
+    таблицы и заполняет их заново в той же транзакции: при ошибке база остаётся прежней.
+    """
+    if scale is None:
+        scale = seed_scale
+    checksum = seed_checksum(scale)
+    state = session.get(SeedState, 'generate_db')
+
+    if mode == 'auto':
+        if state is not None and state.checksum == checksum:
+            return 'skipped'
+        mode = 'generate' if session.scalar(select(Street.street_id).limit(1)) is None else 'reconcile'
+
+    workers = None
+    if mode == 'force':
+        _clear_seeded_tables(session)
+        # Очистка ещё не зафиксирована, поэтому генерация идёт в этой же сессии
+        workers = 1
+    if not generate_db(session, scale, reconcile=(mode == 'reconcile'), workers=workers):
+        return 'failed'
+    session.merge(SeedState(seed_name='generate_db', checksum=checksum, seeded_at=datetime.datetime.now()))
+    session.commit()
+    return 'reconciled' if mode == 'reconcile' else 'generated'
+
+
+def _clear_seeded_tables(session) -> None:
+    seeded = {model.__table__ for model in (Street, Stop, Building, Route, StopsToRoute, PublicTransport)}
+    if session.get_bind().dialect.name == 'postgresql':
+        # Генерация ссылается на id с 1, поэтому счётчики id тоже сбрасываются
+        names = ', '.join(table.name for table in seeded)
+        session.execute(text(f"TRUNCATE {names} RESTART IDENTITY"))
+        return
+    # В SQLite id без AUTOINCREMENT после очистки снова начинаются с 1
+    for table in reversed(DeclarativeBase.metadata.sorted_tables):
+        if table in seeded:
+            session.execute(delete(table))
+
+
+def seed_checksum(scale: int) -> str:
+    digest = hashlib.sha256(f"scale={scale}".encode())
+    for name in (street_file, stop_file):
+        with open(name, mode='rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def generate_db(session, scale: int = None, reconcile: bool = False, workers: int = None) -> bool:
+    """Генерирует все таблицы; фазы и их части выполняются в workers потоков (см. seeding.py)."""
+    if scale is None:
+        scale = seed_scale
+    if workers is None:
+        workers = seed_workers_for(session)
+    # Каждая фаза возвращает строки своей таблицы, разбитые на независимые части
+    phases = {
+        Street: _generate_streets_from_file,
+        Stop: partial(_generate_stops_from_file, scale=scale),
+        Building: partial(_generate_buildings_on_streets_from_file, scale=scale),
+        Route: _generate_routes,
+        StopsToRoute: partial(_generate_stops_to_routes, reconcile=reconcile),
+        PublicTransport: partial(_generate_transport, reconcile=reconcile),
+    }
     try:
-        _generate_streets_from_file(session)
-        _generate_stops_from_file(session)
-        _generate_buildings_on_streets_from_file(session)
-        _generate_routes(session)
-        _generate_stops_to_routes(session)
-        _generate_transport(session)
+        report = run_phases(session, DeclarativeBase.metadata, phases, partial(bulk_add, reconcile=reconcile),
+                            workers, batch_size)
+        session.commit()
+        for table, phase in report.items():
+            print(f"{table}: {phase['rows']} строк за {phase['seconds']} с ({phase['rows_per_second']} строк/с)")
+        return True
     except Exception as e:
+        session.rollback()
         exception_message("Ошибка генерации базы данных", e)
+        return False
+
+
+def bulk_add(session, model, rows: list[dict], reconcile: bool = False) -> int:
+    """Вставляет строки пачками внутри текущей транзакции.
+
+    Каждая пачка выполняется в своей точке сохранения. Если пачка не прошла,
+    её строки вставляются по одной, каждая в отдельной точке сохранения,
+    поэтому ошибочная строка не ломает остальные. При reconcile конфликты
+    с уже существующими строками пропускаются самим INSERT ... ON CONFLICT DO NOTHING.
+    Возвращает число вставленных строк.
+    """
+    statement = _insert_ignoring_conflicts(session, model) if reconcile else insert(model)
+    inserted = 0
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        try:
+            with session.begin_nested():
+                result = session.execute(statement, batch)
+            inserted += max(result.rowcount, 0) if reconcile else len(batch)
+        except Exception:
+            for row in batch:
+                try:
+                    with session.begin_nested():
+                        session.execute(statement, [row])
+                    inserted += 1
+                except Exception as e:
+                    db_changing_exception(e)
+    return inserted
+
+
+def _insert_ignoring_conflicts(session, model):
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(model).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(model).on_conflict_do_nothing()
+    return insert(model).prefix_with('IGNORE')
+
+
+def _has_rows(session, model) -> bool:
+    return session.scalar(select(model.__table__.primary_key.columns[0]).limit(1)) is not None
 
 
 street_file = 'streets.txt'
+stop_file = 'stops.txt'
 
 
-def _generate_streets_from_file(session):
+def _generate_streets_from_file(session) -> list[list[dict]]:
     d = ['Central', 'Soviet', 'North', 'South']
     k = 0
+    rows = []
     with open(street_file, mode='r', encoding='utf-8') as st:
         s = st.readlines()
         for street in s[0].split(" "):
-            add_street(session, street, StreetType.street, random.choice(d))
+            rows.append(_street_row(street, StreetType.street, random.choice(d)))
 
         for street in s[1].split(" "):
-            add_street(session, street, StreetType.avenue, d[k])
+            rows.append(_street_row(street, StreetType.avenue, d[k]))
 
         for street in s[2].split(" "):
-            add_street(session, street, StreetType.lane, d[k])
+            rows.append(_street_row(street, StreetType.lane, d[k]))
 
         for street in s[3].split(" "):
-            add_street(session, street, StreetType.square, d[k])
+            rows.append(_street_row(street, StreetType.square, d[k]))
+
+    return [[row for row in rows if row is not None]]
+
+
+def _street_row(street_name: str, street_type: StreetType, district: str):
+    if street_name.strip() == "":
+        db_changing_exception(Exception(""))
+        return None
+    return {'street_name': street_name.strip(), 'street_type': street_type, 'district': district}
 
 
-def _generate_stops_from_file(session):
-    with open('stops.txt', mode='r', encoding='utf-8') as sp:
-        s_p = sp.readlines()
+def _generate_stops_from_file(session, scale: int = 1) -> list[list[dict]]:
+    with open(stop_file, mode='r', encoding='utf-8') as sp:
+        # Повторяющиеся названия нарушили бы уникальность stop_name
+        s_p = list(dict.fromkeys(name.strip() for name in sp.readlines() if name.strip() != ""))
         with open(street_file, mode='r', encoding='utf-8') as st:
             s = st.readlines()
 
             s = [strt.split(" ") for strt in s]
             s = [name.strip() for sublist in s for name in sublist]
 
-            for name in s_p:
-                add_stop(session, name, random.choice(list(TransportType)),
-                         random.choice([k for k in range(1, len(s) + 1)]))
-
-
-def _generate_buildings_on_streets_from_file(session):
+    parts = []
+    for copy in range(1, scale + 1):
+        rows = []
+        for name in s_p:
+            # При увеличенном масштабе названия остановок дополняются номером копии
+            stop_name = name if copy == 1 else f"{name} {copy}"
+            rows.append({'stop_name': stop_name, 'stop_type': random.choice(list(TransportType)),
+                         'street_id': random.randint(1, len(s))})
+        parts.append(rows)
+    return parts
+
+
+def _generate_buildings_on_streets_from_file(session, scale: int = 1) -> list[list[dict]]:
+    # Здания каждой улицы - отдельная часть
+    parts = []
     with open(street_file, mode='r', encoding='utf-8') as st:
         s = st.readlines()
         k = 1
         for _ in s[0].split(" "):
-            _generate_buildings(session, 60, k)
+            parts.append(_generate_buildings(60 * scale, k, scale))
             k += 1
 
         for _ in s[1].split(" "):
-            _generate_buildings(session, 90, k)
+            parts.append(_generate_buildings(90 * scale, k, scale))
             k += 1
 
         for _ in s[2].split(" "):
-            _generate_buildings(session, 25, k)
+            parts.append(_generate_buildings(25 * scale, k, scale))
             k += 1
 
         for _ in s[3].split(" "):
-            _generate_buildings(session, 15, k)
+            parts.append(_generate_buildings(15 * scale, k, scale))
             k += 1
+    return parts
 
 
-def _generate_buildings(session, buildings_num: int, street_id: int):
-    for i in range(1, buildings_num + 1):
-        add_building(session, i, random.choice(list(BuildingType)),
-                     street_id, random.choice(list(i for i in range(1, stops_number + 1))))
+def _generate_buildings(buildings_num: int, street_id: int, scale: int = 1) -> list[dict]:
+    building_types = list(BuildingType)
+    return [{'building_number': i, 'building_type': random.choice(building_types),
+             'street_id': street_id, 'stop_id': random.randint(1, stops_number * scale)}
+            for i in range(1, buildings_num + 1)]
 
 
-def _generate_routes(session):
+def _generate_routes(session) -> list[list[dict]]:
     numbers = [i for i in range(1, routs_number + 1)]
+    rows = []
     for _ in range(1, routs_number + 1):
         num = random.choice(numbers)
-        add_route(session, num, random.choice(list(RouteType)))
+        rows.append({'route_number': num, 'route_type': random.choice(list(RouteType))})
         numbers.remove(num)
+    return [rows]
 
 
-def _generate_stops_to_routes(session):
-
+def _generate_stops_to_routes(session, reconcile: bool = False) -> list[list[dict]]:
+    # Состав маршрутов случайный, поэтому при сверке он генерируется только для пустой таблицы
+    if reconcile and _has_rows(session, StopsToRoute):
+        return []
+    # Остановки каждого маршрута - отдельная часть
+    parts = []
     for i in range(1, routs_number + 1):
+        rows = []
         k = random.choice([i for i in range(4, routs_number)])
         stops = [i for i in range(1, stops_number + 1)]
         for j in range(1, k + 1):
             stop = random.choice(stops)
-            add_stops_to_route(session, i, stop, j)
+            rows.append({'route_id': i, 'stop_id': stop, 'stop_num_in_route': j})
             stops.remove(stop)
+        parts.append(rows)
+    return parts
 
 
-def _generate_transport(session):
+def _generate_transport(session, reconcile: bool = False) -> list[list[dict]]:
+    if reconcile and _has_rows(session, PublicTransport):
+        return []
     route_numbers = [i for i in range(1, routs_number + 1)]
     numbers = [i for i in range(1, 10)]
     characters = [chr(i) for i in range(ord('А'), ord('Я') + 1)]
+    rows = []
     for _ in range(0, transports_number):
         route = random.choice(route_numbers)
         number = "{}{}{}{}{}{}".format(random.choice(characters),
                                        random.choice(numbers), random.choice(numbers), random.choice(numbers),
                                        random.choice(characters), random.choice(characters))
-        add_public_transport(session, number, route, random.choice(list(TransportType)))
+        rows.append({'transport_number': number, 'route_id': route,
+                     'transport_type': random.choice(list(TransportType))})
         route_numbers.remove(route)
+    return [rows]
 
 
 def add_street(session, street_name: str, street_type: StreetType, district: str):
@@ -0,0 +1,118 @@
+"""Разделение чтения и записи между основной бд и репликами.
+
+Реплики задаются переменной DB_REPLICA_URLS (адреса SQLAlchemy через запятую).
+Для локальной проверки подойдут два файла SQLite, например
+DB_REPLICA_URLS=sqlite:////tmp/replica.db при основной бд в другом файле.
+"""
+import itertools
+import os
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import event, text, Select
+from sqlalchemy.orm import Session, scoped_session
+
+from db_backend import create_db_engine
+from exceptions import exception_message
+
+replica_urls = [url.strip() for url in os.environ.get('DB_REPLICA_URLS', '').split(',') if url.strip()]
+# Как часто перепроверять недоступные реплики, секунды
+replica_check_interval = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 10))
+# Сколько после записи читать с основной бд, пока реплики догоняют её, секунды
+replica_max_lag = float(os.environ.get('DB_REPLICA_MAX_LAG', 1))
+
+PINNED = 'pinned_to_primary'
+
+
+class ReplicaRouter:
+    """Выбирает движок для запроса: основной или очередную живую реплику по кругу."""
+
+    def __init__(self, primary, replicas: list):
+        self.primary = primary
+        self.replicas = replicas
+        self._healthy = {id(replica): True for replica in replicas}
+        # Реплика проверяется перед первым использованием и затем раз в replica_check_interval
+        self._checked = {id(replica): float('-inf') for replica in replicas}
+        self._cycle = itertools.cycle(replicas)
+        self._last_write = 0.0
+        # Повторно входимая: проверка реплики может вызвать _on_error под той же блокировкой
+        self._lock = threading.RLock()
+        for replica in replicas:
+            event.listen(replica, 'handle_error', self._on_error)
+
+    @classmethod
+    def from_urls(cls, primary, urls: list[str], **engine_options) -> 'ReplicaRouter':
+        return cls(primary, [create_db_engine(url, **engine_options) for url in urls])
+
+    def replica(self):
+        """Очередная живая реплика; основная бд, если реплик нет или все недоступны,
+        или если запись была совсем недавно."""
+        if not self.replicas or time.monotonic() - self._last_write < replica_max_lag:
+            return self.primary
+        with self._lock:
+            for _ in range(len(self.replicas)):
+                replica = next(self._cycle)
+                if self._check(replica):
+                    return replica
+        return self.primary
+
+    def wrote(self) -> None:
+        self._last_write = time.monotonic()
+
+    def status(self) -> list[dict]:
+        with self._lock:
+            return [{'url': replica.url.render_as_string(hide_password=True), 'healthy': self._healthy[id(replica)]}
+                    for replica in self.replicas]
+
+    def _check(self, replica) -> bool:
+        if time.monotonic() - self._checked[id(replica)] < replica_check_interval:
+            return self._healthy[id(replica)]
+        self._checked[id(replica)] = time.monotonic()
+        try:
+            with replica.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            self._healthy[id(replica)] = True
+        except Exception as e:
+            self._healthy[id(replica)] = False
+            exception_message("Реплика бд недоступна", e)
+        return self._healthy[id(replica)]
+
+    def _on_error(self, context) -> None:
+        if context.is_disconnect or context.connection is None:
+            engine = context.engine
+            with self._lock:
+                self._healthy[id(engine)] = False
+                self._checked[id(engine)] = time.monotonic()
+
+
+class RoutingSession(Session):
+    """Сессия, отправляющая SELECT на реплики, а всё остальное - на основную бд.
+
+    После первой записи (или pin_primary) сессия до конца запроса читает только
+    с основной бд, чтобы видеть свои изменения. SELECT ... FOR UPDATE всегда
+    идёт на основную бд.
+    """
+
+    def __init__(self, router: Optional[ReplicaRouter] = None, **kw):
+        super().__init__(**kw)
+        self.router = router
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.router is None:
+            return super().get_bind(mapper, clause, **kw)
+        if self._flushing or (clause is not None and not isinstance(clause, Select)):
+            pin_primary(self)
+        elif not self.info.get(PINNED) and isinstance(clause, Select) and clause._for_update_arg is None:
+            return self.router.replica()
+        return self.router.primary
+
+
+def pin_primary(session) -> None:
+    """Дальше в этой сессии и чтение, и запись идут в основную бд."""
+    if isinstance(session, scoped_session):
+        session = session()
+    session.info[PINNED] = True
+    router = getattr(session, 'router', None)
+    if router is not None:
+        router.wrote()
@@ -12,3 +12,11 @@ def db_changing_exception(e: Exception):
 
 def web_exception(e: Exception):
     exception_message("Ошибка при работе с сайтом", e)
+
+
+class StaleRowError(Exception):
+    """Строку изменили с момента чтения: версия в запросе не совпала с версией в бд."""
+
+    def __init__(self, current: dict):
+        super().__init__(f"Строка уже изменена другим пользователем, текущая версия: {current.get('version')}")
+        self.current = current
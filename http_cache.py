@@ -0,0 +1,82 @@
+"""Условные GET-запросы по версиям таблиц и сжатие больших ответов."""
+import gzip
+import os
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from flask import request, Response
+
+from cache import RepositoryCache
+
+compress_min_size = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+compress_level = int(os.environ.get('COMPRESS_LEVEL', 6))
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def validators(cache: RepositoryCache, tables: list[str]) -> tuple[str, datetime]:
+    """ETag и Last-Modified ответа, который зависит только от содержимого tables.
+
+    ETag начинается с начала отсчёта версий кэша. У локального кэша оно своё в
+    каждом процессе, поэтому ETag другого воркера не совпадёт. Записей других
+    процессов (воркеров, flask init-db) локальные версии не видят, поэтому такие
+    ETag и Last-Modified меняются не реже раза в TTL кэша - как и его записи.
+    """
+    versions = '.'.join(str(cache.version(table)) for table in tables)
+    modified = max(cache.modified(table) for table in tables)
+    if not cache.backend.shared:
+        ttl = cache.backend.ttl
+        window = int(time.time() // ttl)
+        versions += f"-{window}"
+        modified = max(modified, window * ttl)
+    # Last-Modified передаётся с точностью до секунды
+    last_modified = datetime.fromtimestamp(int(modified), timezone.utc)
+    return f"{int(cache.epoch * 1000000)}-{versions}", last_modified
+
+
+def not_modified(etag: str, last_modified: datetime) -> Optional[Response]:
+    """Ответ 304, если у клиента уже есть эта версия, иначе None."""
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = request.if_modified_since is not None and last_modified <= request.if_modified_since
+    if not fresh:
+        return None
+    return conditional(Response(status=304), etag, last_modified)
+
+
+def conditional(response: Response, etag: str, last_modified: datetime) -> Response:
+    # Слабый ETag: тело может отдаваться сжатым по-разному
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+def enable_compression(app) -> None:
+    app.after_request(_compress)
+
+
+def _compress(response: Response) -> Response:
+    if (response.status_code < 200 or response.status_code in (204, 304) or response.direct_passthrough
+            or response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < compress_min_size:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        encoding, compress = 'br', lambda data: brotli.compress(data, quality=min(compress_level, 11))
+    elif accepted['gzip']:
+        encoding, compress = 'gzip', lambda data: gzip.compress(data, compresslevel=compress_level)
+    else:
+        return response
+
+    response.set_data(compress(response.get_data()))
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,148 @@
+"""Метрики запросов к приложению и к базе в текстовом формате Prometheus."""
+import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+slow_query_seconds = float(os.environ.get('SLOW_QUERY_MS', 200)) / 1000
+slow_query_log = logging.getLogger('roads.slow_queries')
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...], buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float) -> None:
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Счётчики по корзинам, затем сумма и количество
+                series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        for labels, series in items:
+            base = _labels(self.label_names, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{base}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{base}}} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...]):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple, value: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{{{_labels(self.label_names, labels)}}} {value}")
+        return lines
+
+
+request_duration = Histogram('roads_http_request_duration_seconds', 'Время обработки HTTP-запроса',
+                             ('route', 'method', 'status'))
+query_duration = Histogram('roads_db_query_duration_seconds', 'Время выполнения SQL-запроса', ('statement',))
+query_rows = Counter('roads_db_query_rows_total', 'Строк возвращено или изменено SQL-запросами', ('statement',))
+slow_queries = Counter('roads_db_slow_queries_total', 'SQL-запросы дольше порога SLOW_QUERY_MS', ('statement',))
+
+# Дополнительные источники метрик: функции, возвращающие строки в формате Prometheus
+collectors = []
+
+
+def instrument_engine(engine) -> None:
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def instrument_app(app) -> None:
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def render() -> str:
+    lines = []
+    for metric in (request_duration, query_duration, query_rows, slow_queries):
+        lines.extend(metric.render())
+    for collector in collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+
+def statement_label(statement: str) -> str:
+    """Сокращённый текст запроса без лишних пробелов, списков значений и имён точек сохранения."""
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    statement = re.sub(r'\((?:\s*(?:\?|%\([^)]*\)s|%s|:\w+|\$\d+)\s*,?)+\)', '(...)', statement)
+    statement = re.sub(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+', '(...)', statement)
+    statement = re.sub(r'sa_savepoint_\d+', 'sa_savepoint_N', statement)
+    return statement[:200]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Время начала - в контексте запроса: при ошибке он пропадает вместе с ним
+    context._query_start_time = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_start_time
+    label = (statement_label(statement),)
+    query_duration.observe(label, elapsed)
+    if cursor.rowcount is not None and cursor.rowcount > 0:
+        query_rows.inc(label, cursor.rowcount)
+    if elapsed > slow_query_seconds:
+        slow_queries.inc(label)
+        slow_query_log.warning("slow query %.1f ms: %s", elapsed * 1000, label[0])
+
+
+def _before_request():
+    g.request_start_time = time.perf_counter()
+
+
+def _after_request(response):
+    start = g.pop('request_start_time', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_duration.observe((route, request.method, str(response.status_code)),
+                                 time.perf_counter() - start)
+    return response
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    return ','.join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
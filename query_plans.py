@@ -0,0 +1,98 @@
+"""Проверка планов ключевых запросов приложения.
+
+Запускает EXPLAIN для запросов, которые выполняют репозитории и каскадные
+удаления, и завершается с ошибкой, если какой-либо запрос читает таблицу
+последовательным сканированием, а в таблице больше threshold строк.
+
+    python query_plans.py --seed-scale 20 --threshold 10000
+"""
+import argparse
+import json
+import re
+import sys
+
+from sqlalchemy import select, func, text
+from sqlalchemy.orm import Session
+
+from db_backend import create_db_engine
+from db_construction import DeclarativeBase, Street, Stop, Building, StopsToRoute, PublicTransport
+from db_interactions import generate_db
+
+
+def key_queries():
+    return {
+        'stops_on_street': select(Stop).where(Stop.street_id == 1),
+        'buildings_on_street': select(Building).where(Building.street_id == 1),
+        'buildings_of_stop': select(Building).where(Building.stop_id == 1),
+        'route_in_order': select(StopsToRoute.stop_id).where(StopsToRoute.route_id == 1)
+        .order_by(StopsToRoute.stop_num_in_route),
+        'routes_of_stop': select(StopsToRoute).where(StopsToRoute.stop_id == 1),
+        'transport_on_route': select(PublicTransport).where(PublicTransport.route_id == 1),
+        'building_by_id': select(Building).where(Building.building_id == 1),
+        'street_by_id': select(Street).where(Street.street_id == 1),
+    }
+
+
+def seq_scans(connection, statement) -> list[str]:
+    """Имена таблиц, которые план запроса читает последовательным сканированием."""
+    sql = str(statement.compile(connection.engine, compile_kwargs={'literal_binds': True}))
+    if connection.dialect.name == 'postgresql':
+        plan = connection.execute(text('EXPLAIN (FORMAT JSON) ' + sql)).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return list(_pg_seq_scans(plan[0]['Plan']))
+    tables = []
+    for row in connection.execute(text('EXPLAIN QUERY PLAN ' + sql)):
+        match = re.match(r'SCAN (?:TABLE )?(\w+)', row[-1])
+        if match and 'INDEX' not in row[-1]:
+            tables.append(match.group(1))
+    return tables
+
+
+def _pg_seq_scans(node):
+    if node.get('Node Type') == 'Seq Scan':
+        yield node['Relation Name']
+    for child in node.get('Plans', []):
+        yield from _pg_seq_scans(child)
+
+
+def check_plans(engine, threshold: int) -> list[str]:
+    problems = []
+    with engine.connect() as connection:
+        sizes = {table.name: connection.scalar(select(func.count()).select_from(table))
+                 for table in DeclarativeBase.metadata.sorted_tables}
+        for name, statement in key_queries().items():
+            for table in seq_scans(connection, statement):
+                rows = sizes.get(table, 0)
+                status = 'FAIL' if rows > threshold else 'ok'
+                print(f"{status:4} {name}: Seq Scan on {table} ({rows} rows)")
+                if rows > threshold:
+                    problems.append(f"{name}: {table}")
+    return problems
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='URL базы данных (по умолчанию DATABASE_URL, DB_CONFIG или DATABASE)')
+    parser.add_argument('--threshold', type=int, default=10000,
+                        help='допустимое число строк в таблице для последовательного сканирования')
+    parser.add_argument('--seed-scale', type=int, help='создать схему и заполнить базу с этим масштабом')
+    args = parser.parse_args(argv)
+
+    engine = create_db_engine(args.url)
+    if args.seed_scale:
+        DeclarativeBase.metadata.create_all(engine)
+        with Session(engine) as session:
+            generate_db(session, args.seed_scale)
+    with engine.begin() as connection:
+        connection.execute(text('ANALYZE'))
+
+    problems = check_plans(engine, args.threshold)
+    if problems:
+        print('Регрессия планов запросов:', ', '.join(problems))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
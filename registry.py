@@ -0,0 +1,80 @@
+import functools
+from operator import attrgetter
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy import select, Enum, Integer, String
+
+
+class TableInfo:
+    """Сведения о модели, вычисляемые один раз: столбцы, первичный ключ,
+    функции чтения значений, приведение строк из форм к типам столбцов
+    и готовый SELECT по всем столбцам."""
+
+    def __init__(self, model):
+        table = model.__table__
+        self.model = model
+        self.table = table
+        self.columns = list(table.columns)
+        self.column_names = [column.name for column in self.columns]
+        self.primary_key = table.primary_key.columns[0]
+        self.select_all = select(*self.columns)
+        getter = attrgetter(*self.column_names)
+        self.values = getter if len(self.column_names) > 1 else (lambda entity: (getter(entity),))
+        self.coercers: Dict[str, Callable[[Any], Any]] = {
+            name: coerce for name, coerce in ((column.name, _coercer(column)) for column in self.columns)
+            if coerce is not None}
+
+    def row_values(self, entity) -> Dict[str, Any]:
+        return dict(zip(self.column_names, self.values(entity)))
+
+    def coerce(self, arg: Dict[str, Any]) -> None:
+        """Приводит строковые значения из формы к типам столбцов на месте."""
+        for name, coerce in self.coercers.items():
+            if name in arg and arg[name] is not None:
+                arg[name] = coerce(arg[name])
+
+
+@functools.cache
+def table_info(model) -> TableInfo:
+    return TableInfo(model)
+
+
+def _coercer(column) -> Optional[Callable[[Any], Any]]:
+    if isinstance(column.type, Enum) and column.type.enum_class is not None:
+        enum_class = column.type.enum_class
+
+        # Принимает и 'street', и 'StreetType.street' (так значения выводятся на страницах)
+        def to_enum(value):
+            return value if isinstance(value, enum_class) else enum_class[str(value).rpartition('.')[2]]
+        return to_enum
+    if isinstance(column.type, Integer):
+        return int
+    if isinstance(column.type, String):
+        return str
+    return None
+
+
+class ModelRegistry:
+    """Соответствие подписи таблицы на страницах её модели и репозиторию.
+
+    Новая таблица подключается одной строкой register(подпись, репозиторий).
+    """
+
+    def __init__(self):
+        self._repositories: Dict[str, Any] = {}
+
+    def register(self, label: str, repository) -> None:
+        self._repositories[label] = repository
+
+    def labels(self) -> list[str]:
+        return list(self._repositories)
+
+    def repository(self, label: Optional[str]):
+        return self._repositories.get(label)
+
+    def repositories(self) -> list:
+        return list(self._repositories.values())
+
+    def column_names(self, label: Optional[str]) -> list[str]:
+        repository = self._repositories.get(label)
+        return table_info(repository.model).column_names if repository is not None else []
@@ -1,147 +1,582 @@
-from typing import Generic, TypeVar, Optional, List, Dict, Any
+from typing import Generic, TypeVar, Optional, List, Dict, Any, Iterator, Callable
 
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy import select, func, and_, or_, case, cast, String, insert, update, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, make_transient_to_detached
 
 import exceptions
-from db_construction import Street, Stop, Building, Route, StopsToRoute, PublicTransport, RouteType, TransportType, \
-    BuildingType, StreetType
+from cache import RepositoryCache, MISSING
+from db_routing import pin_primary
+from db_construction import VERSION, Street, Stop, Building, Route, StopsToRoute, PublicTransport
+from registry import table_info
 
 # Общий тип для всех моделей
 T = TypeVar('T')
 
+# Обработчик изменения строки: (действие, новые значения, старые значения)
+ChangeListener = Callable[[str, Dict[str, Any], Optional[Dict[str, Any]]], None]
+
 
 class IRepository(Generic[T]):
     def __init__(self, session: Session, model: T):
         self.session = session
         self.model = model
+        self.info = table_info(model)
+        self.change_listeners: list[ChangeListener] = []
+        self.cache: Optional[RepositoryCache] = None
 
     def add(self, entity: T) -> None:
         try:
+            pin_primary(self.session)
             self.session.add(entity)
+            self.session.flush()
+            row = self.row_values(entity)
             self.session.commit()
+            self._notify('add', row)
         except Exception as e:
+            self.session.rollback()
             exceptions.db_changing_exception(e)
 
     def add_list(self, arg: Dict[str, Any]) -> None:
         try:
-            self.fix_string_args(arg)
-            entity = self.model(**arg)
-            self.add(entity)
+            pk = self.info.primary_key.name
+            arg.pop(VERSION, None)
+            if arg.get(pk) in (None, ''):
+                arg.pop(pk, None)
+                self.fix_string_args(arg)
+                self.add(self.model(**arg))
+            else:
+                self.fix_string_args(arg)
+                self.upsert(arg)
+        except Exception as e:
+            exceptions.db_changing_exception(e)
+
+    def upsert(self, values: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Добавляет строку с заданным id или перезаписывает существующую:
+        INSERT ... ON CONFLICT (pk) DO UPDATE ... RETURNING."""
+        try:
+            pin_primary(self.session)
+            dialect = self.session.get_bind().dialect.name
+            old = self._current_row(values[self.info.primary_key.name], lock=True)
+            statement = self._upsert_statement(values, dialect)
+            if statement is not None:
+                row = dict(self.session.execute(statement).mappings().one())
+                if old is None and dialect == 'postgresql':
+                    self.session.execute(self._sync_sequence_statement())
+            elif old is None:
+                row = dict(self.session.execute(self._insert_statement(values)).mappings().one())
+            else:
+                _, statement = self._update_statement(values, dialect)
+                row, _ = self._split_returning(self.session.execute(statement).mappings().one())
+            self.session.commit()
         except Exception as e:
+            self.session.rollback()
             exceptions.db_changing_exception(e)
+            return None
+        self._notify('add' if old is None else 'update', row, old)
+        return row
 
     def get(self, entity_id: int) -> Optional[T]:
         try:
-            return self.session.get(self.model, entity_id)
+            if self.cache is None:
+                return self.session.get(self.model, entity_id)
+
+            key = self.cache.key(self.model.__tablename__, 'row', entity_id)
+            row = self.cache.get(key)
+            if row is MISSING:
+                entity = self.session.get(self.model, entity_id)
+                self.cache.set(key, None if entity is None else self.row_values(entity))
+                return entity
+            if row is None:
+                return None
+            # Восстанавливаем объект из кэша и присоединяем к сессии без SELECT
+            entity = self.model(**row)
+            make_transient_to_detached(entity)
+            return self.session.merge(entity, load=False)
         except Exception as e:
             exceptions.db_changing_exception(e)
             return []
 
-    def delete(self, entity: T) -> None:
+    def delete(self, entity: T) -> Optional[Dict[str, int]]:
+        return self.delete_by_id(self.row_values(entity)[self.info.primary_key.name])
+
+    def delete_by_id(self, id_arg: int) -> Optional[Dict[str, int]]:
+        return self.delete_where(self.info.primary_key == id_arg)
+
+    def delete_by_ids(self, ids: list[int]) -> Optional[Dict[str, int]]:
+        return self.delete_where(self.info.primary_key.in_(ids))
+
+    def delete_by_filter(self, filters: Dict[str, Any]) -> Optional[Dict[str, int]]:
+        """Удаляет строки, у которых столбцы равны значениям filters."""
+        unknown = set(filters) - set(self.info.column_names)
+        if not filters or unknown:
+            raise ValueError(f"Некорректный фильтр: {', '.join(unknown) or 'пустой'}")
+        values = dict(filters)
+        try:
+            self.fix_string_args(values)
+        except (KeyError, ValueError) as e:
+            raise ValueError(f"Некорректное значение в фильтре: {e}") from e
+        table = self.model.__table__
+        return self.delete_where(and_(*(table.c[name] == value for name, value in values.items())))
+
+    def delete_where(self, where) -> Optional[Dict[str, int]]:
+        """Удаляет строки по условию одной командой DELETE ... RETURNING; зависимые
+        строки удаляет сама бд (ON DELETE CASCADE).
+
+        Возвращает число удалённых строк по таблицам: зависимые считаются одним
+        запросом перед удалением.
+        """
         try:
-            self.session.delete(entity)
+            # Удаляемые строки читаются с основной бд: на реплику они могли ещё не попасть
+            pin_primary(self.session)
+            counts_statement, delete_statement = self._delete_statements(where)
+            counts = dict(self.session.execute(counts_statement).mappings().one()) if counts_statement is not None \
+                else {}
+            rows = [dict(row) for row in self.session.execute(delete_statement).mappings()]
             self.session.commit()
         except Exception as e:
+            self.session.rollback()
             exceptions.db_changing_exception(e)
+            return None
+        for row in rows:
+            self._notify('delete', row)
+        return {self.model.__tablename__: len(rows), **counts}
+
+    def _delete_statements(self, where):
+        """(запрос числа каскадно удаляемых строк по таблицам или None, DELETE ... RETURNING)."""
+        table = self.model.__table__
+        conditions = _cascade_conditions(table, where)
+        counts = [select(func.count()).select_from(dependent).where(condition).scalar_subquery().label(dependent.name)
+                  for dependent, condition in conditions.items() if dependent is not table]
+        return (select(*counts) if counts else None), delete(table).where(where).returning(*table.c)
+
+    def update(self, entity: T) -> Optional[Dict[str, Any]]:
+        # Только заданные у объекта атрибуты, как при merge
+        values = {name: value for name, value in self.row_values(entity).items() if name in vars(entity)}
+        return self.update_list(values)
+
+    def update_list(self, arg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        try:
+            self.fix_string_args(arg)
+            return self.update_values(arg)
+        except exceptions.StaleRowError:
+            raise
+        except Exception as e:
+            exceptions.db_changing_exception(e)
+            return None
 
-    def delete_by_id(self, id_arg: int) -> None:
-        entity = self.get(id_arg)
-        print(type(entity), entity)
-        self.delete(entity)
+    def update_values(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        """Обновляет строку одной командой UPDATE ... WHERE pk = :id AND version = :v RETURNING.
 
-    def update(self, entity: T) -> None:
+        Если в values есть version, строка меняется, только пока её никто не изменил
+        после чтения, иначе поднимается StaleRowError с текущими значениями строки.
+        Без version проверки нет, но версия всё равно увеличивается.
+        """
         try:
-            self.session.merge(entity)
+            pin_primary(self.session)
+            dialect = self.session.get_bind().dialect.name
+            _id, statement = self._update_statement(values, dialect)
+            # В PostgreSQL старые значения возвращает сама команда, в остальных бд их читаем заранее
+            old = None if dialect == 'postgresql' else self._current_row(_id, lock=True)
+            result = self.session.execute(statement).mappings().first()
+            if result is None:
+                raise self._update_failure(_id)
+            row, returned_old = self._split_returning(result)
+            old = returned_old or old
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        self._notify('update', row, old)
+        return row
+
+    def _update_statement(self, values: Dict[str, Any], dialect: str):
+        table = self.model.__table__
+        pk = self.info.primary_key
+        values = dict(values)
+        _id = values.pop(pk.name)
+        expected = values.pop(VERSION, None)
+        statement = update(table).values(**values, **{VERSION: table.c[VERSION] + 1})
+        if dialect == 'postgresql':
+            # UPDATE ... FROM (SELECT ... FOR UPDATE) old RETURNING new.*, old.*
+            old = select(table).where(pk == _id).with_for_update().subquery('old')
+            statement = statement.where(pk == old.c[pk.name]).returning(
+                *table.c, *(column.label(f'old_{column.name}') for column in old.c))
+        else:
+            statement = statement.where(pk == _id).returning(*table.c)
+        if expected not in (None, ''):
+            statement = statement.where(table.c[VERSION] == int(expected))
+        return _id, statement
+
+    def _upsert_statement(self, values: Dict[str, Any], dialect: str):
+        if dialect == 'postgresql':
+            statement = postgresql.insert(self.model.__table__).values(**values)
+        elif dialect == 'sqlite':
+            statement = sqlite.insert(self.model.__table__).values(**values)
+        else:
+            return None
+        table = self.model.__table__
+        pk = self.info.primary_key.name
+        changes = {name: statement.excluded[name] for name in values if name != pk}
+        changes[VERSION] = table.c[VERSION] + 1
+        return statement.on_conflict_do_update(index_elements=[pk], set_=changes).returning(*table.c)
+
+    def _insert_statement(self, values: Dict[str, Any]):
+        return insert(self.model.__table__).values(**values).returning(*self.model.__table__.c)
+
+    def _sync_sequence_statement(self):
+        # Явно заданный id не сдвигает последовательность, поэтому догоняем её до максимума
+        table = self.model.__table__
+        pk = self.info.primary_key
+        return select(func.setval(func.pg_get_serial_sequence(table.name, pk.name),
+                                  select(func.max(pk)).scalar_subquery()))
+
+    def _current_row(self, entity_id, lock: bool = False) -> Optional[Dict[str, Any]]:
+        query = self.info.select_all.where(self.info.primary_key == entity_id)
+        if lock:
+            query = query.with_for_update()
+        row = self.session.execute(query).mappings().first()
+        return dict(row) if row is not None else None
+
+    def _update_failure(self, entity_id) -> Exception:
+        current = self._current_row(entity_id)
+        if current is None:
+            return LookupError(f"Такого id нет в базе данных: {entity_id}")
+        return exceptions.StaleRowError(current)
+
+    def _split_returning(self, result) -> tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        row = {name: result[name] for name in self.info.column_names}
+        if f'old_{self.info.primary_key.name}' not in result:
+            return row, None
+        return row, {name: result[f'old_{name}'] for name in self.info.column_names}
+
+    def apply_batch(self, operations: list[Dict[str, Any]]) -> list[Dict[str, Any]]:
+        """Применяет пачку операций add/update/delete одной транзакцией.
+
+        Операции группируются по действию и выполняются наборами: один INSERT
+        на все добавления, UPDATE по первичному ключу в режиме executemany,
+        один DELETE ... WHERE pk IN (...) (с каскадом на зависимые таблицы).
+        Если группа не проходит, её строки повторяются по одной в точках
+        сохранения, чтобы вернуть результат для каждой операции.
+        """
+        pk = self.info.primary_key
+        pin_primary(self.session)
+        results: list[Optional[Dict[str, Any]]] = [None] * len(operations)
+        groups = {'add': [], 'update': [], 'delete': []}
+
+        for index, operation in enumerate(operations):
+            try:
+                action = operation.get('action')
+                if action == 'delete':
+                    groups[action].append((index, int(operation['id'])))
+                elif action in ('add', 'update'):
+                    data = dict(operation['data'])
+                    if action == 'add':
+                        data.pop(pk.name, None)
+                        data.pop(VERSION, None)
+                    self.fix_string_args(data)
+                    if action == 'update':
+                        data[pk.name] = int(data[pk.name])
+                    groups[action].append((index, data))
+                else:
+                    raise ValueError(f"Неизвестное действие: {action}")
+            except Exception as e:
+                results[index] = {'ok': False, 'error': str(e)}
+
+        # Старые значения изменяемых строк одним запросом с блокировкой:
+        # для проверки id и версий и для уведомлений
+        ids = [data[pk.name] for _, data in groups['update']] + [_id for _, _id in groups['delete']]
+        old_rows = {}
+        if ids:
+            old_rows = {row[pk.name]: dict(row) for row in self.session.execute(
+                self.info.select_all.where(pk.in_(ids)).with_for_update()).mappings()}
+        for action in ('update', 'delete'):
+            present = []
+            for index, payload in groups[action]:
+                _id = payload if action == 'delete' else payload[pk.name]
+                if _id not in old_rows:
+                    results[index] = {'ok': False, 'error': f"Такого id нет в базе данных: {_id}"}
+                    continue
+                if action == 'update':
+                    current = old_rows[_id][VERSION]
+                    if payload.get(VERSION) not in (None, '', current):
+                        error = exceptions.StaleRowError(old_rows[_id])
+                        results[index] = {'ok': False, 'error': str(error), 'conflict': True, VERSION: current}
+                        continue
+                    payload[VERSION] = current + 1
+                present.append((index, payload))
+            groups[action] = present
+
+        done = []
+        try:
+            for index, outcome in self._execute_group(groups['add'], self._insert_rows):
+                done.append((index, 'add', outcome))
+            for index, outcome in self._execute_group(groups['update'], self._update_rows):
+                done.append((index, 'update', outcome))
+            for index, outcome in self._execute_group(groups['delete'], self._delete_rows):
+                done.append((index, 'delete', outcome))
             self.session.commit()
         except Exception as e:
+            self.session.rollback()
             exceptions.db_changing_exception(e)
-
-    def update_list(self, arg: Dict[str, Any]) -> None:
+            for index, _, _ in done:
+                results[index] = {'ok': False, 'error': str(e)}
+            return results
+
+        for index, action, outcome in done:
+            if isinstance(outcome, Exception):
+                results[index] = {'ok': False, 'error': str(outcome)}
+                continue
+            row = outcome if action != 'delete' else old_rows[outcome]
+            results[index] = {'ok': True, 'id': row[pk.name]}
+            self._notify(action, row, old_rows.get(row[pk.name]) if action == 'update' else None)
+        return results
+
+    def _execute_group(self, items: list[tuple[int, Any]], execute) -> list[tuple[int, Any]]:
+        if not items:
+            return []
         try:
-            self.fix_string_args(arg)
-            entity = self.model(**arg)
-            self.update(entity)
+            with self.session.begin_nested():
+                outcomes = execute([payload for _, payload in items])
+            return [(index, outcome) for (index, _), outcome in zip(items, outcomes)]
+        except Exception:
+            pass
+
+        results = []
+        for index, payload in items:
+            try:
+                with self.session.begin_nested():
+                    results.append((index, execute([payload])[0]))
+            except Exception as e:
+                exceptions.db_changing_exception(e)
+                results.append((index, e))
+        return results
+
+    def _insert_rows(self, rows: list[Dict[str, Any]]) -> list[Dict[str, Any]]:
+        pk = self.info.primary_key
+        ids = self.session.execute(insert(self.model.__table__).returning(pk, sort_by_parameter_order=True),
+                                   rows).scalars().all()
+        return [dict(row, **{pk.name: _id}) for row, _id in zip(rows, ids)]
+
+    def _update_rows(self, rows: list[Dict[str, Any]]) -> list[Dict[str, Any]]:
+        # ORM-обновление по первичному ключу: один UPDATE в режиме executemany,
+        # затем один SELECT, чтобы обработчики получили строки целиком, а не присланные поля
+        pk = self.info.primary_key
+        self.session.execute(update(self.model), rows)
+        stored = {row[pk.name]: dict(row) for row in self.session.execute(
+            self.info.select_all.where(pk.in_([row[pk.name] for row in rows]))).mappings()}
+        return [stored[row[pk.name]] for row in rows]
+
+    def _delete_rows(self, ids: list[int]) -> list[int]:
+        # Зависимые строки удаляет сама бд (ON DELETE CASCADE)
+        self.session.execute(delete(self.model.__table__).where(self.info.primary_key.in_(ids)))
+        return ids
+
+    def all(self) -> list[list]:
+        if self.cache is None:
+            return [list(row) for row in self.iter_rows()]
+
+        key = self.cache.key(self.model.__tablename__, 'all')
+        rows = self.cache.get(key)
+        if rows is MISSING:
+            rows = list(self.iter_rows())
+            if len(rows) <= self.cache.max_cached_rows:
+                self.cache.set(key, rows)
+        return [list(row) for row in rows]
+
+    def iter_rows(self, batch_size: int = 1000) -> Iterator[tuple]:
+        """Построчно отдаёт значения столбцов таблицы, не создавая ORM-объектов.
+
+        Строки читаются с сервера пачками по batch_size (серверный курсор),
+        поэтому память не зависит от размера таблицы.
+        """
+        try:
+            query = self.info.select_all.execution_options(yield_per=batch_size)
+            for row in self.session.execute(query):
+                yield tuple(row)
         except Exception as e:
             exceptions.db_changing_exception(e)
 
-    def all(self) -> list[T]:
+    def page(self, start: int, length: int, order_column: int = 0, order_dir: str = 'asc',
+             search: str = '') -> tuple[int, int, list[list]]:
+        """Возвращает (всего строк, строк после фильтра, строки окна) для серверной пагинации."""
         try:
-            records = self.session.query(self.model).all()
-            field_values_list = []
-
-            # Проходим по всем записям
-            for record in records:
-                # Извлекаем значения полей в виде словаря
-                field_values = [getattr(record, column.name) for column in self.model.__table__.columns]
-                field_values_list.append(field_values)
-
-            return field_values_list
+            columns = self.info.columns
+            total = self.session.scalar(select(func.count()).select_from(self.model))
+
+            query = self.info.select_all
+            filtered = total
+            if search:
+                pattern = f"%{search}%"
+                query = query.where(or_(*(cast(column, String).ilike(pattern) for column in columns)))
+                filtered = self.session.scalar(select(func.count()).select_from(query.subquery()))
+
+            order_by = columns[order_column] if 0 <= order_column < len(columns) else columns[0]
+            order_by = order_by.desc() if order_dir == 'desc' else order_by.asc()
+            # Первичный ключ в конце сортировки делает страницы стабильными
+            query = query.order_by(order_by, self.info.primary_key)
+            query = query.offset(start)
+            if length >= 0:
+                query = query.limit(length)
+
+            return total, filtered, [list(row) for row in self.session.execute(query)]
         except Exception as e:
             exceptions.db_changing_exception(e)
-            return []
+            return 0, 0, []
 
     def fields_list(self, instance_id):
+        if self.cache is not None:
+            key = self.cache.key(self.model.__tablename__, 'fields', instance_id)
+            fields = self.cache.get(key)
+            if fields is not MISSING:
+                return None if fields is None else list(fields)
+
         instance = self.session.query(self.model).get(instance_id)
+        fields = None
         if instance is not None:
-            return [getattr(instance, field.key) for field in self.model.__table__.c]
-        return None
+            fields = list(self.info.values(instance))
+        if self.cache is not None:
+            self.cache.set(key, fields)
+        return fields
+
+    def row_values(self, entity: T) -> Dict[str, Any]:
+        return self.info.row_values(entity)
+
+    def primary_key_value(self, entity: T):
+        return getattr(entity, self.info.primary_key.name)
+
+    def _notify(self, action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]] = None) -> None:
+        if self.cache is not None:
+            # Удаление каскадно затрагивает зависимые таблицы
+            tables = dependent_tables(self.model.__table__) if action == 'delete' else [self.model.__table__]
+            for table in tables:
+                self.cache.invalidate(table.name)
+        for listener in self.change_listeners:
+            try:
+                listener(action, row, old)
+            except Exception as e:
+                exceptions.exception_message("Ошибка обработчика изменений", e)
 
     def fix_string_args(self, arg: Dict[str, Any]):
-        pass
+        # Пустая версия из формы - это "без проверки версии", а не int('')
+        if arg.get(VERSION) == '':
+            arg.pop(VERSION)
+        self.info.coerce(arg)
+
+
+def dependent_tables(table) -> list:
+    """Таблица и все таблицы, ссылающиеся на неё внешними ключами (транзитивно)."""
+    result = [table]
+    for other in table.metadata.sorted_tables:
+        if other not in result and any(fk.column.table in result for fk in other.foreign_keys):
+            result.append(other)
+    return result
+
+
+def _cascade_conditions(table, where) -> Dict[Any, Any]:
+    """Для таблицы и каждой зависимой - условие на её строки, которые удалятся
+    каскадно вместе со строками table по условию where."""
+    conditions = {table: where}
+    for dependent in dependent_tables(table)[1:]:
+        conditions[dependent] = or_(*(fk.parent.in_(select(fk.column).where(conditions[fk.column.table]))
+                                      for fk in dependent.foreign_keys if fk.column.table in conditions))
+    return conditions
 
 
 class StreetRepository(IRepository[Street]):
     def __init__(self, session: Session):
         super().__init__(session, Street)
 
-    def fix_string_args(self, arg: Dict[str, Any]):
-        arg["street_type"] = StreetType[(arg["street_type"]).split(".")[-1]]
-
 
 class StopRepository(IRepository[Stop]):
     def __init__(self, session: Session):
         super().__init__(session, Stop)
 
-    def fix_string_args(self, arg: Dict[str, Any]):
-        arg["stop_type"] = TransportType[(arg["stop_type"]).split(".")[-1]]
-        arg["street_id"] = int(arg["street_id"])
-
 
 class BuildingRepository(IRepository[Building]):
     def __init__(self, session: Session):
         super().__init__(session, Building)
 
-    def fix_string_args(self, arg: Dict[str, Any]):
-        arg["building_number"] = int(arg["building_number"])
-        arg["building_type"] = BuildingType[(arg["building_type"]).split(".")[-1]]
-        arg["stop_id"] = int(arg["stop_id"])
-        arg["street_id"] = int(arg["street_id"])
-
 
 class RouteRepository(IRepository[Route]):
     def __init__(self, session: Session):
         super().__init__(session, Route)
 
-    def fix_string_args(self, arg: Dict[str, Any]):
-        arg["route_number"] = int(arg["route_number"])
-        arg["route_type"] = RouteType[(arg["route_type"]).split(".")[-1]]
-
 
 class StopsToRouteRepository(IRepository[StopsToRoute]):
     def __init__(self, session: Session):
         super().__init__(session, StopsToRoute)
 
-    def fix_string_args(self, arg: Dict[str, Any]):
-        arg["route_id"] = int(arg["route_id"])
-        arg["stop_id"] = int(arg["stop_id"])
-        arg["stop_num_in_route"] = int(arg["stop_num_in_route"])
+    def route_stops(self, route_id: int) -> list[int]:
+        return list(self.session.scalars(select(StopsToRoute.stop_id).where(StopsToRoute.route_id == route_id)
+                                         .order_by(StopsToRoute.stop_num_in_route)))
+
+    def resequence(self, route_id: int, stop_ids: list[int]) -> Optional[Dict[str, Any]]:
+        """Задаёт маршруту новый порядок остановок целиком, в одной транзакции.
+
+        Число команд не зависит от длины маршрута: DELETE убранных остановок,
+        два UPDATE переставленных (сначала во временные отрицательные номера, чтобы
+        не нарушить уникальность (route_id, stop_num_in_route) посреди команды,
+        затем в новые) и один INSERT добавленных. Остановки на прежних местах не трогаются.
+        """
+        if len(set(stop_ids)) != len(stop_ids):
+            raise ValueError("Остановка встречается в маршруте дважды")
+        table = self.model.__table__
+        positions = {stop_id: position for position, stop_id in enumerate(stop_ids, start=1)}
+        try:
+            pin_primary(self.session)
+            # Блокировка маршрута: параллельные правки одного маршрута выполняются по очереди
+            if self.session.scalar(select(Route.route_id).where(Route.route_id == route_id).with_for_update()) is None:
+                raise LookupError(f"Такого маршрута нет: {route_id}")
+            current = {row['stop_id']: dict(row) for row in self.session.execute(
+                self.info.select_all.where(table.c.route_id == route_id).with_for_update()).mappings()}
+            added = [stop_id for stop_id in stop_ids if stop_id not in current]
+            if added:
+                known = set(self.session.scalars(select(Stop.stop_id).where(Stop.stop_id.in_(added))))
+                if len(known) != len(added):
+                    raise LookupError(f"Таких остановок нет: {', '.join(str(i) for i in added if i not in known)}")
+            removed = [row for stop_id, row in current.items() if stop_id not in positions]
+            moved = [stop_id for stop_id, row in current.items()
+                     if stop_id in positions and row['stop_num_in_route'] != positions[stop_id]]
+
+            in_route = table.c.route_id == route_id
+            if removed:
+                removed_ids = [row['stop_id'] for row in removed]
+                self.session.execute(delete(table).where(in_route, table.c.stop_id.in_(removed_ids)))
+            updated = []
+            if moved:
+                self.session.execute(update(table).where(in_route, table.c.stop_id.in_(moved))
+                                     .values(stop_num_in_route=-table.c.stop_num_in_route))
+                new_position = case({stop_id: positions[stop_id] for stop_id in moved}, value=table.c.stop_id)
+                updated = [dict(row) for row in self.session.execute(
+                    update(table).where(in_route, table.c.stop_id.in_(moved))
+                    .values(stop_num_in_route=new_position, **{VERSION: table.c[VERSION] + 1})
+                    .returning(*table.c)).mappings()]
+            inserted = []
+            if added:
+                inserted = [dict(row) for row in self.session.execute(
+                    insert(table).returning(*table.c, sort_by_parameter_order=True),
+                    [{'route_id': route_id, 'stop_id': stop_id, 'stop_num_in_route': positions[stop_id]}
+                     for stop_id in added]).mappings()]
+            self.session.commit()
+        except LookupError:
+            self.session.rollback()
+            raise
+        except Exception as e:
+            self.session.rollback()
+            exceptions.db_changing_exception(e)
+            return None
+
+        for row in removed:
+            self._notify('delete', row)
+        for row in updated:
+            self._notify('update', row, current[row['stop_id']])
+        for row in inserted:
+            self._notify('add', row)
+        return {'route_id': route_id, 'stops': stop_ids,
+                'added': len(inserted), 'moved': len(updated), 'removed': len(removed)}
 
 
 class PublicTransportRepository(IRepository[PublicTransport]):
     def __init__(self, session: Session):
         super().__init__(session, PublicTransport)
-
-    def fix_string_args(self, arg: Dict[str, Any]):
-        arg["route_id"] = int(arg["route_id"])
-        arg["transport_type"] = TransportType[(arg["transport_type"]).split(".")[-1]]
@@ -0,0 +1,228 @@
+import threading
+from array import array
+from typing import Optional, Dict, Any
+
+from sqlalchemy import select
+
+from db_construction import StopsToRoute, Stop, Route
+
+INF = 2 ** 31 - 1
+# Значение NULL в целых столбцах снимка (snapshot.NULL_INT)
+NULL_INT = -2 ** 63
+
+
+class RoutePlanner:
+    """Планировщик поездок по графу маршрутов из stops_to_route.
+
+    Граф хранится в CSR-виде на массивах: идентификаторы остановок и маршрутов
+    отображаются в плотные индексы, для каждого маршрута хранится упорядоченный
+    список остановок, для каждой остановки - список проходящих через неё маршрутов.
+    Поиск идёт раундами в духе RAPTOR: раунд k - поездка с k - 1 пересадками,
+    внутри раунда минимизируется число проезжаемых остановок.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._lock = threading.Lock()
+        # route_id -> упорядоченный список stop_id; источник данных для CSR
+        self._route_stops: Dict[int, list[int]] = {}
+        self._dirty_routes: set[int] = set()
+        self._loaded = False
+        self._stop_names: Dict[int, str] = {}
+        self._route_numbers: Dict[int, int] = {}
+
+    def reload(self) -> None:
+        with self._lock:
+            self._load_all()
+
+    def load_snapshot(self, stops_to_route, stops, routes) -> None:
+        """Строит граф по таблицам снимка (snapshot.SnapshotTable) без запросов к бд."""
+        route_column, stop_column = stops_to_route.column('route_id'), stops_to_route.column('stop_id')
+        order = stops_to_route.column('stop_num_in_route')
+        entries = sorted((route_column[i], order[i], stop_column[i]) for i in range(stops_to_route.row_count)
+                         if route_column[i] != NULL_INT and stop_column[i] != NULL_INT)
+        with self._lock:
+            self._route_stops = {}
+            for route_id, _, stop_id in entries:
+                self._route_stops.setdefault(route_id, []).append(stop_id)
+            stop_names = stops.column('stop_name')
+            self._stop_names = {stop_id: stop_names[i] for i, stop_id in enumerate(stops.column('stop_id'))}
+            self._route_numbers = dict(zip(routes.column('route_id'), routes.column('route_number')))
+            self._dirty_routes.clear()
+            self._loaded = True
+            self._build()
+
+    def invalidate_route(self, route_id: Optional[int]) -> None:
+        """Помечает маршрут изменённым; он будет перечитан перед следующим запросом."""
+        if route_id is not None:
+            with self._lock:
+                self._dirty_routes.add(route_id)
+
+    def invalidate_all(self) -> None:
+        with self._lock:
+            self._loaded = False
+
+    def on_stops_to_route_change(self, action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]]) -> None:
+        self.invalidate_route(row.get('route_id'))
+        if old is not None:
+            self.invalidate_route(old.get('route_id'))
+
+    def on_route_change(self, action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]]) -> None:
+        self.invalidate_route(row.get('route_id'))
+
+    def on_stop_change(self, action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]]) -> None:
+        # Удаление остановки каскадно затрагивает произвольные маршруты
+        self.invalidate_all()
+
+    def on_street_change(self, action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]]) -> None:
+        # Удаление улицы каскадно удаляет её остановки; остальные изменения улиц граф не задевают
+        if action == 'delete':
+            self.invalidate_all()
+
+    def plan(self, from_stop: int, to_stop: int) -> Optional[list[Dict[str, Any]]]:
+        """Возвращает список участков поездки с наименьшим числом пересадок,
+        а при равенстве - с наименьшим числом остановок. None, если пути нет."""
+        with self._lock:
+            self._refresh()
+            source = self._stop_index.get(from_stop)
+            target = self._stop_index.get(to_stop)
+            if source is None or target is None:
+                return None
+            if source == target:
+                return []
+            return self._search(source, target)
+
+    def _refresh(self) -> None:
+        if not self._loaded:
+            self._load_all()
+        elif self._dirty_routes:
+            self._load_routes(self._dirty_routes)
+            self._dirty_routes.clear()
+            self._build()
+
+    def _load_all(self) -> None:
+        rows = self.session.execute(
+            select(StopsToRoute.route_id, StopsToRoute.stop_id)
+            .order_by(StopsToRoute.route_id, StopsToRoute.stop_num_in_route))
+        self._route_stops = {}
+        for route_id, stop_id in rows:
+            if route_id is not None and stop_id is not None:
+                self._route_stops.setdefault(route_id, []).append(stop_id)
+        self._stop_names = dict(self.session.execute(select(Stop.stop_id, Stop.stop_name)).all())
+        self._route_numbers = dict(self.session.execute(select(Route.route_id, Route.route_number)).all())
+        self._dirty_routes.clear()
+        self._loaded = True
+        self._build()
+
+    def _load_routes(self, route_ids) -> None:
+        route_ids = list(route_ids)
+        for route_id in route_ids:
+            self._route_stops.pop(route_id, None)
+            self._route_numbers.pop(route_id, None)
+        rows = self.session.execute(
+            select(StopsToRoute.route_id, StopsToRoute.stop_id)
+            .where(StopsToRoute.route_id.in_(route_ids))
+            .order_by(StopsToRoute.route_id, StopsToRoute.stop_num_in_route))
+        new_stops = set()
+        for route_id, stop_id in rows:
+            if stop_id is not None:
+                self._route_stops.setdefault(route_id, []).append(stop_id)
+                new_stops.add(stop_id)
+        self._route_numbers.update(self.session.execute(
+            select(Route.route_id, Route.route_number).where(Route.route_id.in_(route_ids))).all())
+        missing = new_stops - self._stop_names.keys()
+        if missing:
+            self._stop_names.update(self.session.execute(
+                select(Stop.stop_id, Stop.stop_name).where(Stop.stop_id.in_(missing))).all())
+
+    def _build(self) -> None:
+        route_ids = sorted(self._route_stops)
+        stop_ids = sorted({stop_id for stops in self._route_stops.values() for stop_id in stops})
+        self._route_ids = array('i', route_ids)
+        self._stop_ids = array('i', stop_ids)
+        self._stop_index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+
+        # Маршрут -> остановки по порядку
+        self._route_offsets = array('i', [0])
+        self._route_seq = array('i')
+        for route_id in route_ids:
+            self._route_seq.extend(self._stop_index[stop_id] for stop_id in self._route_stops[route_id])
+            self._route_offsets.append(len(self._route_seq))
+
+        # Остановка -> маршруты (подсчёт степеней, затем раскладка)
+        counts = array('i', bytes(4 * (len(stop_ids) + 1)))
+        for stop in self._route_seq:
+            counts[stop + 1] += 1
+        for i in range(len(stop_ids)):
+            counts[i + 1] += counts[i]
+        self._stop_offsets = array('i', counts)
+        self._stop_routes = array('i', bytes(4 * len(self._route_seq)))
+        fill = array('i', counts)
+        for route in range(len(route_ids)):
+            for k in range(self._route_offsets[route], self._route_offsets[route + 1]):
+                stop = self._route_seq[k]
+                self._stop_routes[fill[stop]] = route
+                fill[stop] += 1
+
+    def _search(self, source: int, target: int) -> Optional[list[Dict[str, Any]]]:
+        n = len(self._stop_ids)
+        labels = array('i', [INF]) * n
+        labels[source] = 0
+        marked = {source}
+        # parents[k][stop] = (маршрут, остановка посадки) для поездки, улучшенной в раунде k
+        parents = []
+
+        while marked:
+            routes = {self._stop_routes[k] for stop in marked
+                      for k in range(self._stop_offsets[stop], self._stop_offsets[stop + 1])}
+            new_labels = array('i', labels)
+            round_parents = {}
+            for route in routes:
+                begin, end = self._route_offsets[route], self._route_offsets[route + 1]
+                # Проезд по маршруту в обе стороны: стоимость = метка посадки + расстояние
+                self._scan(route, range(begin, end), begin, 1, labels, marked, new_labels, round_parents)
+                self._scan(route, range(end - 1, begin - 1, -1), end - 1, -1, labels, marked, new_labels,
+                           round_parents)
+            parents.append(round_parents)
+            marked = set(round_parents)
+            labels = new_labels
+            if target in round_parents:
+                return self._legs(parents, target)
+        return None
+
+    def _scan(self, route, positions, origin, step, labels, marked, new_labels, round_parents) -> None:
+        best, board = INF, -1
+        for k in positions:
+            stop = self._route_seq[k]
+            offset = (k - origin) * step
+            if best != INF and best + offset < new_labels[stop]:
+                new_labels[stop] = best + offset
+                round_parents[stop] = (route, board)
+            if stop in marked and labels[stop] - offset < best:
+                best, board = labels[stop] - offset, stop
+
+    def _legs(self, parents, target) -> list[Dict[str, Any]]:
+        legs = []
+        stop = target
+        for round_parents in reversed(parents):
+            if stop not in round_parents:
+                continue
+            route, board = round_parents[stop]
+            route_id = self._route_ids[route]
+            begin, end = self._route_offsets[route], self._route_offsets[route + 1]
+            seq = list(self._route_seq[begin:end])
+            i, j = seq.index(board), seq.index(stop)
+            legs.append({
+                'route_id': route_id,
+                'route_number': self._route_numbers.get(route_id),
+                'from_stop': self._describe(board),
+                'to_stop': self._describe(stop),
+                'stops': [self._stop_ids[s] for s in (seq[i:j + 1] if i <= j else seq[j:i + 1][::-1])],
+            })
+            stop = board
+        legs.reverse()
+        return legs
+
+    def _describe(self, stop: int) -> Dict[str, Any]:
+        stop_id = self._stop_ids[stop]
+        return {'stop_id': stop_id, 'stop_name': self._stop_names.get(stop_id)}
@@ -0,0 +1,120 @@
+import threading
+from typing import Optional, Dict, Any
+
+from sqlalchemy import select, insert, delete, func
+from sqlalchemy.orm import selectinload
+
+from db_construction import RouteTimeline, StopsToRoute, Route, Stop, Street, PublicTransport
+from exceptions import db_changing_exception
+
+
+class RouteTimelineView:
+    """Поддерживает сводную таблицу route_timeline: остановки маршрута по порядку
+    с улицей, районом и числом машин на маршруте.
+
+    Изменения репозиториев помечают затронутые маршруты, а refresh_pending()
+    (в конце запроса) пересчитывает только их одним INSERT ... SELECT на пачку.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._lock = threading.Lock()
+        self._dirty_routes: set[int] = set()
+        self._dirty_stops: set[int] = set()
+        self._dirty_streets: set[int] = set()
+
+    def on_route_change(self, action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]]) -> None:
+        self._mark(self._dirty_routes, row, old, 'route_id')
+
+    def on_stop_change(self, action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]]) -> None:
+        self._mark(self._dirty_stops, row, old, 'stop_id')
+
+    def on_street_change(self, action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]]) -> None:
+        self._mark(self._dirty_streets, row, old, 'street_id')
+
+    def refresh_pending(self) -> None:
+        with self._lock:
+            routes, stops, streets = self._dirty_routes, self._dirty_stops, self._dirty_streets
+            self._dirty_routes, self._dirty_stops, self._dirty_streets = set(), set(), set()
+        if not (routes or stops or streets):
+            return
+        try:
+            # Маршруты, проходящие через изменённые остановки и улицы, берутся из самой сводки:
+            # после каскадного удаления в исходных таблицах их уже нет
+            if stops or streets:
+                routes |= set(self.session.scalars(select(RouteTimeline.route_id).distinct().where(
+                    RouteTimeline.stop_id.in_(stops) | RouteTimeline.street_id.in_(streets))))
+                routes |= set(self.session.scalars(select(StopsToRoute.route_id).distinct().join(Stop).where(
+                    Stop.stop_id.in_(stops) | Stop.street_id.in_(streets))))
+            self._rebuild(routes)
+        except Exception as e:
+            self.session.rollback()
+            db_changing_exception(e)
+
+    def refresh_all(self) -> None:
+        try:
+            self._rebuild(None)
+        except Exception as e:
+            self.session.rollback()
+            db_changing_exception(e)
+
+    def timeline(self, route_number: int) -> Optional[Dict[str, Any]]:
+        rows = self.session.scalars(select(RouteTimeline).where(RouteTimeline.route_number == route_number)
+                                    .order_by(RouteTimeline.stop_num_in_route)).all()
+        if rows:
+            return {
+                'route_id': rows[0].route_id,
+                'route_number': route_number,
+                'vehicle_count': rows[0].vehicle_count,
+                'stops': [{'stop_num_in_route': row.stop_num_in_route, 'stop_id': row.stop_id,
+                           'stop_name': row.stop_name, 'street_name': row.street_name, 'district': row.district}
+                          for row in rows],
+            }
+        return self._timeline_from_source(route_number)
+
+    def _timeline_from_source(self, route_number: int) -> Optional[Dict[str, Any]]:
+        # Сводка ещё не построена или маршрут без остановок: читаем исходные таблицы,
+        # подгружая связи заранее, без N+1 ленивых загрузок
+        route = self.session.scalars(
+            select(Route).where(Route.route_number == route_number)
+            .options(selectinload(Route.public_transports),
+                     selectinload(Route.stops_to_routes).joinedload(StopsToRoute.stop).joinedload(Stop.street))
+        ).first()
+        if route is None:
+            return None
+        return {
+            'route_id': route.route_id,
+            'route_number': route.route_number,
+            'vehicle_count': len(route.public_transports),
+            'stops': [{'stop_num_in_route': item.stop_num_in_route, 'stop_id': item.stop.stop_id,
+                       'stop_name': item.stop.stop_name, 'street_name': item.stop.street.street_name,
+                       'district': item.stop.street.district}
+                      for item in sorted(route.stops_to_routes, key=lambda item: item.stop_num_in_route)],
+        }
+
+    def _rebuild(self, route_ids: Optional[set[int]]) -> None:
+        vehicles = (select(PublicTransport.route_id, func.count().label('vehicle_count'))
+                    .group_by(PublicTransport.route_id).subquery())
+        source = (select(StopsToRoute.route_id, StopsToRoute.stop_num_in_route, Route.route_number,
+                         Stop.stop_id, Stop.stop_name, Street.street_id, Street.street_name, Street.district,
+                         func.coalesce(vehicles.c.vehicle_count, 0))
+                  .join(Route, Route.route_id == StopsToRoute.route_id)
+                  .join(Stop, Stop.stop_id == StopsToRoute.stop_id)
+                  .join(Street, Street.street_id == Stop.street_id)
+                  .outerjoin(vehicles, vehicles.c.route_id == StopsToRoute.route_id))
+        clear = delete(RouteTimeline)
+        if route_ids is not None:
+            source = source.where(StopsToRoute.route_id.in_(route_ids))
+            clear = clear.where(RouteTimeline.route_id.in_(route_ids))
+
+        self.session.execute(clear)
+        self.session.execute(insert(RouteTimeline).from_select(
+            ['route_id', 'stop_num_in_route', 'route_number', 'stop_id', 'stop_name', 'street_id', 'street_name',
+             'district', 'vehicle_count'], source))
+        self.session.commit()
+
+    def _mark(self, target: set, row: Dict[str, Any], old: Optional[Dict[str, Any]], key: str) -> None:
+        with self._lock:
+            for values in (row, old):
+                if values is not None and values.get(key) is not None:
+                    target.add(values[key])
@@ -0,0 +1,202 @@
+import re
+import threading
+from bisect import bisect_left, insort
+from operator import itemgetter
+from typing import Optional, Dict, Any
+
+from sqlalchemy import select, or_, case, func, cast, String
+
+from db_construction import Stop, Street, Route
+
+# Что ищем: вид результата -> (модель, столбец id, столбец названия)
+SEARCH_TARGETS = {
+    'stop': (Stop, Stop.stop_id, Stop.stop_name),
+    'street': (Street, Street.street_id, Street.street_name),
+    'route': (Route, Route.route_id, Route.route_number),
+}
+
+_WORD = re.compile(r'[^\W_]+')
+
+# Минимальная длина запроса, с которой ищутся варианты с опечаткой
+MIN_TYPO_LENGTH = 3
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр, ё -> е, всё кроме букв и цифр - одиночные пробелы."""
+    return ' '.join(_WORD.findall(str(text).lower().replace('ё', 'е')))
+
+
+class PrefixIndex:
+    """Отсортированный массив ключей для поиска по префиксу в памяти процесса.
+
+    Для каждого названия хранятся ключи, начинающиеся с каждого его слова,
+    поэтому запрос совпадает с началом любого слова ('сказ' находит 'Лесная сказка').
+    Поиск - двоичный по массиву; опечатки (одна замена, вставка, удаление или
+    перестановка соседних букв) обрабатываются перебором вариантов запроса.
+    """
+
+    def __init__(self):
+        # (ключ, вид, id, ключ с начала названия) в порядке ключа
+        self._entries: list[tuple[str, str, int, bool]] = []
+        self._names: Dict[tuple[str, int], str] = {}
+        self._alphabet: set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def load(self, items) -> None:
+        """Строит индекс заново из (вид, id, название)."""
+        entries = []
+        self._names = {}
+        self._alphabet = set()
+        for kind, _id, name in items:
+            self._names[(kind, _id)] = str(name)
+            entries.extend(self._keys(kind, _id, name))
+        # Порядок только по ключу: так сортировка в разы быстрее, чем по кортежам целиком
+        entries.sort(key=itemgetter(0))
+        self._entries = entries
+
+    def add(self, kind: str, _id: int, name) -> None:
+        self.remove(kind, _id)
+        self._names[(kind, _id)] = str(name)
+        for entry in self._keys(kind, _id, name):
+            insort(self._entries, entry, key=itemgetter(0))
+
+    def remove(self, kind: str, _id: int) -> None:
+        name = self._names.pop((kind, _id), None)
+        if name is None:
+            return
+        for entry in self._keys(kind, _id, name):
+            index = bisect_left(self._entries, entry[0], key=itemgetter(0))
+            while index < len(self._entries) and self._entries[index][0] == entry[0]:
+                if self._entries[index] == entry:
+                    del self._entries[index]
+                    break
+                index += 1
+
+    def search(self, query: str, limit: int = 10) -> list[Dict[str, Any]]:
+        query = normalize(query)
+        if not query:
+            return []
+        found: Dict[tuple[str, int], tuple] = {}
+        self._collect(query, 0, limit, found)
+        if len(found) < limit and len(query) >= MIN_TYPO_LENGTH:
+            for variant in self._typo_variants(query):
+                self._collect(variant, 1, limit, found)
+        ranked = sorted(found.items(), key=lambda item: item[1])[:limit]
+        return [{'kind': kind, 'id': _id, 'name': self._names[(kind, _id)], 'typos': rank[0]}
+                for (kind, _id), rank in ranked]
+
+    def _collect(self, prefix: str, typos: int, limit: int, found: Dict[tuple[str, int], tuple]) -> None:
+        entries = self._entries
+        index = bisect_left(entries, prefix, key=itemgetter(0))
+        # Берём с запасом: одно название встречается под несколькими ключами
+        end = min(index + limit * 4, len(entries))
+        while index < end and entries[index][0].startswith(prefix):
+            key, kind, _id, from_start = entries[index]
+            # Сначала без опечаток, затем совпадения с начала названия, затем короткие
+            rank = (typos, not from_start, len(self._names[(kind, _id)]), key)
+            if found.get((kind, _id), rank) >= rank:
+                found[(kind, _id)] = rank
+            index += 1
+
+    def _typo_variants(self, query: str) -> set[str]:
+        letters = self._alphabet
+        variants = set()
+        for i in range(len(query)):
+            variants.add(query[:i] + query[i + 1:])
+            if i + 1 < len(query):
+                variants.add(query[:i] + query[i + 1] + query[i] + query[i + 2:])
+            for letter in letters:
+                variants.add(query[:i] + letter + query[i + 1:])
+                variants.add(query[:i] + letter + query[i:])
+        variants.discard(query)
+        variants.discard('')
+        return variants
+
+    def _keys(self, kind: str, _id: int, name) -> list[tuple[str, str, int, bool]]:
+        words = normalize(name).split(' ')
+        self._alphabet.update(''.join(words))
+        return [(' '.join(words[i:]), kind, _id, i == 0) for i in range(len(words)) if words[i]]
+
+
+class SearchService:
+    """Автодополнение по названиям остановок и улиц и номерам маршрутов.
+
+    В PostgreSQL поиск идёт по триграммным индексам (pg_trgm) с ранжированием
+    по word_similarity, что даёт устойчивость к опечаткам. В остальных бд
+    используется PrefixIndex в памяти, который обновляется по уведомлениям
+    репозиториев.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._lock = threading.Lock()
+        self._index = PrefixIndex()
+        self._loaded = False
+
+    def search(self, query: str, limit: int = 10) -> list[Dict[str, Any]]:
+        if self.session.get_bind().dialect.name == 'postgresql':
+            return self._search_sql(query, limit)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return self._index.search(query, limit)
+
+    def invalidate_all(self) -> None:
+        with self._lock:
+            self._loaded = False
+
+    def on_stop_change(self, action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]]) -> None:
+        self._apply('stop', action, row.get('stop_id'), row.get('stop_name'))
+
+    def on_street_change(self, action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]]) -> None:
+        if action == 'delete':
+            # Вместе с улицей каскадно удаляются её остановки
+            self.invalidate_all()
+        else:
+            self._apply('street', action, row.get('street_id'), row.get('street_name'))
+
+    def on_route_change(self, action: str, row: Dict[str, Any], old: Optional[Dict[str, Any]]) -> None:
+        self._apply('route', action, row.get('route_id'), row.get('route_number'))
+
+    def _apply(self, kind: str, action: str, _id: Optional[int], name) -> None:
+        with self._lock:
+            if not self._loaded or _id is None:
+                return
+            if action == 'delete':
+                self._index.remove(kind, _id)
+            elif name is not None:
+                self._index.add(kind, _id, name)
+
+    def _load(self) -> None:
+        items = []
+        for kind, (model, id_column, name_column) in SEARCH_TARGETS.items():
+            query = select(id_column, name_column).execution_options(yield_per=10000)
+            items.extend((kind, _id, name) for _id, name in self.session.execute(query))
+        self._index.load(items)
+        self._loaded = True
+
+    def _search_sql(self, query: str, limit: int) -> list[Dict[str, Any]]:
+        query = query.strip()
+        if not query:
+            return []
+        escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        results = []
+        for kind, (model, id_column, name_column) in SEARCH_TARGETS.items():
+            name = cast(name_column, String) if kind == 'route' else name_column
+            # Начало названия или любого слова в нём; остальное - по похожести триграмм
+            prefix = or_(name.ilike(f'{escaped}%'), name.ilike(f'% {escaped}%'))
+            condition = prefix if kind == 'route' else or_(prefix, name.op('%>')(query))
+            typos = case((prefix, 0), else_=1)
+            statement = (select(id_column, name, typos.label('typos'),
+                                func.word_similarity(query, name).label('score'))
+                         .where(condition)
+                         .order_by(typos, func.word_similarity(query, name).desc(), func.length(name))
+                         .limit(limit))
+            results.extend({'kind': kind, 'id': row[0], 'name': str(row[1]), 'typos': row[2], 'score': row[3]}
+                           for row in self.session.execute(statement))
+        results.sort(key=lambda result: (result['typos'], -result['score'], len(result['name'])))
+        for result in results:
+            result.pop('score')
+        return results[:limit]
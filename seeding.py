@@ -0,0 +1,101 @@
+"""Планировщик заполнения базы: фазы по таблицам в порядке внешних ключей.
+
+Фаза - это функция, которая возвращает строки своей таблицы, разбитые на части
+(например, здания по улицам). Фаза запускается, как только готовы все таблицы,
+на которые ссылаются её внешние ключи, поэтому независимые фазы (здания и маршруты)
+идут одновременно, а части фазы раздаются потокам пула, каждый со своим
+соединением из пула движка.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Any
+
+from sqlalchemy.orm import Session
+
+# Количество потоков заполнения; по умолчанию - по числу ядер
+seed_workers = int(os.environ.get('SEED_WORKERS', os.cpu_count() or 1))
+
+
+def table_dependencies(metadata, tables) -> Dict[str, set[str]]:
+    """Для каждой таблицы из tables - таблицы из tables, на которые она ссылается."""
+    names = set(tables)
+    return {table.name: {key.column.table.name for key in table.foreign_keys
+                         if key.column.table.name in names and key.column.table.name != table.name}
+            for table in metadata.sorted_tables if table.name in names}
+
+
+def seed_workers_for(session) -> int:
+    # SQLite пускает только одного писателя: параллельные транзакции ждали бы блокировку
+    if session.get_bind().dialect.name == 'sqlite':
+        return 1
+    return max(seed_workers, 1)
+
+
+def run_phases(session, metadata, phases: Dict[Any, Callable], load: Callable,
+               workers: int = 1, chunk_rows: int = 10000) -> Dict[str, Dict[str, float]]:
+    """Выполняет фазы phases (модель -> функция(session) -> список частей) и
+    возвращает по каждой таблице число строк, время и строк в секунду.
+
+    load(session, model, rows) вставляет строки. При workers == 1 всё идёт
+    последовательно в session одной транзакцией, как раньше. Иначе каждая порция
+    вставляется и фиксируется в отдельной сессии; если фаза упала, уже
+    зафиксированные порции остаются в базе и дозаполняются сверкой (reconcile).
+    """
+    models = {model.__tablename__: model for model in phases}
+    dependencies = table_dependencies(metadata, models)
+    report = {}
+    if workers <= 1:
+        for table in metadata.sorted_tables:
+            if table.name in models:
+                started = time.perf_counter()
+                rows = [row for part in phases[models[table.name]](session) for row in part]
+                load(session, models[table.name], rows)
+                report[table.name] = _throughput(len(rows), time.perf_counter() - started)
+        return report
+
+    engine = session.get_bind()
+
+    def load_chunk(model, rows):
+        with Session(engine) as worker:
+            load(worker, model, rows)
+            worker.commit()
+        return len(rows)
+
+    done: set[str] = set()
+    running: Dict[str, list] = {}
+    started: Dict[str, float] = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='seed') as pool:
+        while len(done) < len(models):
+            for name in models:
+                if name not in done and name not in running and dependencies[name] <= done:
+                    started[name] = time.perf_counter()
+                    parts = phases[models[name]](session)
+                    running[name] = [pool.submit(load_chunk, models[name], chunk)
+                                     for chunk in _chunks(parts, chunk_rows)]
+            # Только незавершённые порции: иначе wait возвращался бы сразу и цикл крутился вхолостую
+            pending = [future for name_futures in running.values() for future in name_futures if not future.done()]
+            if pending:
+                wait(pending, return_when=FIRST_COMPLETED)
+            for name in [name for name, name_futures in running.items() if all(f.done() for f in name_futures)]:
+                # result() пробрасывает ошибку порции дальше
+                rows = sum(future.result() for future in running.pop(name))
+                report[name] = _throughput(rows, time.perf_counter() - started[name])
+                done.add(name)
+    return report
+
+
+def _chunks(parts, chunk_rows: int):
+    """Склеивает мелкие части в порции не меньше chunk_rows строк (кроме последней)."""
+    chunk = []
+    for part in parts:
+        chunk.extend(part)
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _throughput(rows: int, seconds: float) -> Dict[str, float]:
+    return {'rows': rows, 'seconds': round(seconds, 3), 'rows_per_second': round(rows / seconds) if seconds else 0}
@@ -0,0 +1,287 @@
+"""Столбцовый снимок таблиц сети на диске и его загрузка через mmap.
+
+Каждый столбец - отдельный файл .npy (формат NumPy 1.0, пишется без NumPy):
+  целые - <i8, NULL хранится как INT64_MIN;
+  перечисления - коды |i1 и словарь имён в manifest.json, NULL - код -1;
+  строки - смещения <i8 (n + 1 штук) в file.offsets.npy и байты UTF-8 в file.data.npy.
+С NumPy их можно открыть как np.load(path, mmap_mode='r'); Snapshot
+отображает их в память и отдаёт memoryview без копирования.
+"""
+import ast
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+from array import array
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional
+
+from sqlalchemy import select, func, literal_column, Enum, Integer, String
+
+from db_construction import Street, Stop, Building, Route, StopsToRoute, PublicTransport
+
+SNAPSHOT_MODELS = (Street, Stop, Building, Route, StopsToRoute, PublicTransport)
+MANIFEST = 'manifest.json'
+NULL_INT = -2 ** 63
+NULL_CODE = -1
+
+_NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# typecode массива -> descr в заголовке .npy
+_DESCR = {'q': '<i8', 'b': '|i1', 'B': '|u1'}
+_TYPECODE = {descr: typecode for typecode, descr in _DESCR.items()}
+
+
+def fingerprint(session, model) -> list[int]:
+    """Число строк и хэш их содержимого.
+
+    Счётчики вроде суммы версий и наибольшего id совпадают после пересоздания
+    данных (init-db --mode force) или вставки на место удалённой строки с тем же id,
+    поэтому сравнивается содержимое. В PostgreSQL хэши строк складываются на
+    сервере, в остальных бд строки читаются по порядку id и хэшируются здесь.
+    """
+    table = model.__table__
+    if session.get_bind().dialect.name == 'postgresql':
+        row_text = literal_column(f"{session.get_bind().dialect.identifier_preparer.quote(table.name)}::text")
+        count, content = session.execute(select(func.count(), func.coalesce(func.sum(
+            func.hashtextextended(row_text, 0)), 0)).select_from(table)).one()
+        return [int(count), int(content)]
+    digest = hashlib.blake2b(digest_size=8)
+    count = 0
+    query = select(*table.columns).order_by(table.primary_key.columns[0]).execution_options(yield_per=10000)
+    for row in session.execute(query):
+        digest.update(repr(tuple(row)).encode('utf-8'))
+        count += 1
+    return [count, int.from_bytes(digest.digest(), 'little', signed=True)]
+
+
+def write_snapshot(session, directory: str, batch_size: int = 10000) -> Dict[str, Any]:
+    """Записывает все таблицы сети в directory и возвращает manifest.
+
+    Таблицы читаются в одной транзакции сессии; каталог заменяется целиком
+    только после успешной записи.
+    """
+    tmp = directory.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    manifest = {'created_at': datetime.now().isoformat(timespec='seconds'), 'tables': {}}
+    for model in SNAPSHOT_MODELS:
+        manifest['tables'][model.__tablename__] = _write_table(session, model, tmp, batch_size)
+    with open(os.path.join(tmp, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp, directory)
+    return manifest
+
+
+def _write_table(session, model, directory: str, batch_size: int) -> Dict[str, Any]:
+    table = model.__table__
+    columns = []
+    for column in table.columns:
+        if isinstance(column.type, Enum):
+            members = list(column.type.enum_class)
+            columns.append({'name': column.name, 'kind': 'enum', 'dictionary': [m.name for m in members],
+                            'values': array('b'), 'codes': {m: i for i, m in enumerate(members)}})
+        elif isinstance(column.type, Integer):
+            columns.append({'name': column.name, 'kind': 'int', 'values': array('q')})
+        elif isinstance(column.type, String):
+            columns.append({'name': column.name, 'kind': 'str', 'offsets': array('q', [0]), 'data': bytearray()})
+        else:
+            raise TypeError(f"Тип столбца {table.name}.{column.name} не поддерживается снимком")
+
+    query = select(*table.columns).order_by(table.primary_key.columns[0]).execution_options(yield_per=batch_size)
+    for row in session.execute(query):
+        for column, value in zip(columns, row):
+            if column['kind'] == 'int':
+                column['values'].append(NULL_INT if value is None else value)
+            elif column['kind'] == 'enum':
+                column['values'].append(NULL_CODE if value is None else column['codes'][value])
+            else:
+                column['data'] += (value or '').encode('utf-8')
+                column['offsets'].append(len(column['data']))
+
+    described = []
+    for column in columns:
+        base = os.path.join(directory, f"{table.name}.{column['name']}")
+        if column['kind'] == 'str':
+            _write_npy(base + '.offsets.npy', column['offsets'])
+            _write_npy(base + '.data.npy', array('B', column['data']))
+        else:
+            _write_npy(base + '.npy', column['values'])
+        described.append({key: column[key] for key in ('name', 'kind', 'dictionary') if key in column})
+    table_fingerprint = fingerprint(session, model)
+    return {'columns': described, 'rows': table_fingerprint[0], 'fingerprint': table_fingerprint}
+
+
+def _write_npy(path: str, values: array) -> None:
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (_DESCR[values.typecode], len(values))
+    # Данные начинаются с границы 64 байт, заголовок заканчивается переводом строки
+    padding = -(len(_NPY_MAGIC) + 2 + len(header) + 1) % 64
+    header = header + ' ' * padding + '\n'
+    if sys.byteorder == 'big' and values.itemsize > 1:
+        values = array(values.typecode, values)
+        values.byteswap()
+    with open(path, 'wb') as f:
+        f.write(_NPY_MAGIC + struct.pack('<H', len(header)) + header.encode('latin1'))
+        values.tofile(f)
+
+
+class Snapshot:
+    """Снимок, отображённый в память. Столбцы читаются без копирования."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        self._maps: list[mmap.mmap] = []
+        self._tables: Dict[str, SnapshotTable] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def table_names(self) -> list[str]:
+        return list(self.manifest['tables'])
+
+    def table(self, name: str) -> Optional['SnapshotTable']:
+        if name not in self.manifest['tables']:
+            return None
+        if name not in self._tables:
+            self._tables[name] = SnapshotTable(self, name, self.manifest['tables'][name])
+        return self._tables[name]
+
+    def close(self) -> None:
+        for table in self._tables.values():
+            table.release()
+        self._tables.clear()
+        for mapped in self._maps:
+            mapped.close()
+        self._maps.clear()
+
+    def _map_npy(self, path: str) -> memoryview:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        if mapped[:len(_NPY_MAGIC)] != _NPY_MAGIC:
+            raise ValueError(f"Файл {path} не в формате .npy 1.0")
+        header_length = struct.unpack('<H', mapped[8:10])[0]
+        header = ast.literal_eval(mapped[10:10 + header_length].decode('latin1'))
+        typecode = _TYPECODE[header['descr']]
+        if sys.byteorder == 'big' and header['descr'].startswith('<'):
+            raise ValueError("Снимок записан на little-endian машине")
+        return memoryview(mapped)[10 + header_length:].cast(typecode)
+
+
+class SnapshotTable:
+    def __init__(self, snapshot: Snapshot, name: str, description: Dict[str, Any]):
+        self.name = name
+        self.row_count = description['rows']
+        self.fingerprint = description['fingerprint']
+        self.column_names = [column['name'] for column in description['columns']]
+        self._columns: Dict[str, Any] = {}
+        for column in description['columns']:
+            base = os.path.join(snapshot.directory, f"{name}.{column['name']}")
+            if column['kind'] == 'str':
+                self._columns[column['name']] = StringColumn(snapshot._map_npy(base + '.offsets.npy'),
+                                                             snapshot._map_npy(base + '.data.npy'))
+            elif column['kind'] == 'enum':
+                enum_class = _enum_class(name, column['name'])
+                self._columns[column['name']] = EnumColumn(snapshot._map_npy(base + '.npy'),
+                                                           [enum_class[member] for member in column['dictionary']])
+            else:
+                self._columns[column['name']] = snapshot._map_npy(base + '.npy')
+
+    def column(self, name: str):
+        """memoryview для целых столбцов, EnumColumn и StringColumn для остальных."""
+        return self._columns[name]
+
+    def rows(self) -> Iterator[tuple]:
+        columns = [self._columns[name] for name in self.column_names]
+        for i in range(self.row_count):
+            yield tuple(_value(column, i) for column in columns)
+
+    def release(self) -> None:
+        for column in self._columns.values():
+            column.release()
+        self._columns.clear()
+
+
+class StringColumn:
+    def __init__(self, offsets: memoryview, data: memoryview):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def release(self) -> None:
+        self.offsets.release()
+        self.data.release()
+
+
+class EnumColumn:
+    def __init__(self, codes: memoryview, members: list):
+        self.codes = codes
+        self.members = members
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, i: int):
+        code = self.codes[i]
+        return None if code == NULL_CODE else self.members[code]
+
+    def release(self) -> None:
+        self.codes.release()
+
+
+def _value(column, i: int):
+    value = column[i]
+    return None if value == NULL_INT else value
+
+
+def _enum_class(table_name: str, column_name: str):
+    for model in SNAPSHOT_MODELS:
+        if model.__tablename__ == table_name:
+            return model.__table__.c[column_name].type.enum_class
+    raise KeyError(table_name)
+
+
+def warm_start(snapshot: Snapshot, session, repositories, cache=None, planner=None) -> Dict[str, str]:
+    """Заполняет кэш репозиториев и планировщик из снимка.
+
+    Таблица берётся из снимка, только если её отпечаток (fingerprint) совпадает
+    с текущим в бд; иначе она остаётся холодной. Возвращает состояние по таблицам.
+    """
+    result = {}
+    fresh = {}
+    for repository in repositories:
+        name = repository.model.__tablename__
+        table = snapshot.table(name)
+        if table is None:
+            result[name] = 'missing'
+        elif table.fingerprint != fingerprint(session, repository.model):
+            result[name] = 'stale'
+        else:
+            fresh[name] = table
+            result[name] = 'fresh'
+            if cache is not None and repository.cache is not None and table.row_count <= cache.max_cached_rows:
+                rows = list(table.rows())
+                cache.set(cache.key(name, 'all'), rows)
+                for row in rows:
+                    values = dict(zip(table.column_names, row))
+                    cache.set(cache.key(name, 'row', row[0]), values)
+                    cache.set(cache.key(name, 'fields', row[0]), list(row))
+                result[name] = 'cached'
+    if planner is not None and all(name in fresh for name in ('stops_to_route', 'stop', 'route')):
+        planner.load_snapshot(fresh['stops_to_route'], fresh['stop'], fresh['route'])
+        result['route_planner'] = 'loaded'
+    return result